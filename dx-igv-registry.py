@@ -11,17 +11,69 @@
 # Mark Cowley, 31/1/2017
 ##############################
 
+import time
+START_TIME = time.time()
+
 import argparse
-import glob
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import copy
+import errno
+import fcntl
+import hashlib
+import hmac
+import importlib
+import io
+import json
+import mimetypes
+import mmap
 import os
+import pickle
+import random
 import shutil
+import signal
+import struct
 import grp
-from urllib import quote
-from xml.etree.ElementTree import ElementTree, Element, SubElement, tostring
-import xml.dom.minidom
-import dxpy
+import threading
+from urllib import quote, unquote
 import sys
 import socket
+import zlib
+
+# (module name, seconds taken to import it), for --timings
+IMPORT_TIMES = []
+
+
+class LazyModule(object):
+    """
+    A module that is only imported when one of its attributes is first used. dxpy (with requests and urllib3), and
+    the XML and SQLite modules, take a noticeable time to import, which commands such as --help, or those that only
+    work on local files, shouldn't have to wait for.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            start = time.time()
+            module = importlib.import_module(self._name)
+            IMPORT_TIMES.append((self._name, time.time() - start))
+            self.__dict__["_module"] = module
+        return getattr(self._module, attr)
+
+
+dxpy = LazyModule("dxpy")
+etree = LazyModule("xml.etree.ElementTree")
+minidom = LazyModule("xml.dom.minidom")
+sqlite3 = LazyModule("sqlite3")
+BaseHTTPServer = LazyModule("BaseHTTPServer")
+gzip = LazyModule("gzip")
+email_utils = LazyModule("email.utils")
+Queue = LazyModule("Queue")
+urlparse = LazyModule("urlparse")
+httplib = LazyModule("httplib")
 
 ONE_HOUR = 3600
 ONE_DAY = ONE_HOUR * 24
@@ -29,16 +81,107 @@ ONE_WEEK = ONE_DAY * 7
 ONE_MONTH = ONE_DAY * 31
 ONE_YEAR = ONE_DAY * 365
 
+TDF_SUFFIX = " (+ tdf)"
+# the output formats that a DxDataset can be rendered to
+OUTPUT_FORMATS = ("xml", "json", "session")
+# shared manifest stores live within this folder of the igvdata root (see `IgvRegistry`'s `shared`)
+SHARED_FOLDER = "_shared"
+# characters left unquoted in manifest URLs
+URL_SAFE = "%/:=&?~#+!$,;'@()*[]"
+# small track files, that IGV loads whole, can be copied into the registry's MIRROR_FOLDER (see `IgvRegistry.mirror`)
+MIRRORED_EXTENSIONS = (".seg", ".cn", ".bed.gz", ".bw")
+MIRROR_FOLDER = "_mirror"
+# coverage derived from the index of BAMs that have no TDF (see `IgvRegistry.addBaiCoverage`) is kept in this folder
+COVERAGE_FOLDER = "_coverage"
+# TDF zoom levels below this are prewarmed (see `tdf_prewarm_ranges`), as well as the genome-wide view
+TDF_PREWARM_ZOOMS = 3
+# igv.js track settings for each of the file types that we register, keyed by file extension
+IGVJS_TRACK_TYPES = (
+    ("bam", {"type": "alignment", "format": "bam"}),
+    ("vcf.gz", {"type": "variant", "format": "vcf"}),
+    ("bw", {"type": "wig", "format": "bigwig"}),
+    ("tdf", {"type": "wig", "format": "tdf"}),
+    ("bed.gz", {"type": "annotation", "format": "bed"}),
+    ("seg", {"type": "seg", "format": "seg"}),
+    ("cn", {"type": "seg", "format": "cn"}),
+)
+# igv.js genome id's, for each IGV ref_genome name
+IGVJS_GENOMES = {"1kg_v37": "hg19", "hg19": "hg19", "mm10": "mm10"}
+
+class Resource(namedtuple('Resource', ['file_id', 'name', 'folder', 'path', 'index', 'coverage', 'mapping',
+                                       'index_id', 'coverage_id'])):
+    """
+    A single IGV-loadable file found during a crawl of a DX project.
+
+    Resources are plain tuples, so they are small, immutable and cheap to pickle. Optional attributes are None when
+    they don't apply, eg only BAMs have a coverage, only tabix-indexed VCFs have a mapping, and files that aren't on
+    DNAnexus (eg derived coverage) have no file_id.
+    """
+    __slots__ = ()
+
+    def __new__(cls, file_id, name, folder, path, index=None, coverage=None, mapping=None, index_id=None,
+                coverage_id=None):
+        return super(Resource, cls).__new__(cls, file_id, name, folder, path, index, coverage, mapping, index_id,
+                                            coverage_id)
+
+
+class Folder(object):
+    """
+    A node in the folder tree of a DxDataset, holding the sub-folders and Resources found within one DX folder.
+    """
+    __slots__ = ('name', 'path', 'folders', 'resources')
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.folders = []
+        self.resources = []
+
+    def __getstate__(self):
+        return (self.name, self.path, self.folders, self.resources)
+
+    def __setstate__(self, state):
+        self.name, self.path, self.folders, self.resources = state
+
+    def walk(self):
+        """Iterate over this Folder, and all Folders beneath it, parents before children."""
+        yield self
+        for subfolder in self.folders:
+            for folder in subfolder.walk():
+                yield folder
+
+    def getResources(self):
+        """:return: list of every Resource within this Folder, and all Folders beneath it"""
+        return [resource for folder in self.walk() for resource in folder.resources]
+
+
+def file_name(resource):
+    """:return: the DX file name of a Resource, ie its name without any decoration such as TDF_SUFFIX"""
+    if resource.name.endswith(TDF_SUFFIX):
+        return resource.name[:-len(TDF_SUFFIX)]
+    return resource.name
+
+
+def sample_name(resource):
+    """:return: the sample that a Resource belongs to, ie the file name up to the first '.'"""
+    return file_name(resource).split(".")[0]
+
+
 class DxDataset(object):
     """
-    Represent an DX Project as an IGV dataset, in XML format
+    Represent an DX Project as an IGV dataset.
+
+    Crawling a project builds a tree of Folder and Resource records (`self.root`), which is independent of any output
+    format. The renderers (eg `toXML`) consume that tree.
     """
 
-    def __init__(self, project, ref_genome="1kg_v37", url_duration=ONE_YEAR):
+    def __init__(self, project, ref_genome="1kg_v37", url_duration=ONE_YEAR, describe=None):
         """
         :param project: 
         :param ref_genome: 
         :param url_duration: number of seconds for which the generated URL will be valid 
+        :param describe: the project's description, with at least its name and modified time, if it is already known
+        (eg from `dxpy.find_projects`). Otherwise the project is described.
         """
         if isinstance(project, dxpy.DXProject):
             pass
@@ -49,32 +192,72 @@ class DxDataset(object):
 
         assert isinstance(project, dxpy.DXProject)
         self.project = project
-
-        Global = Element('Global')
-        Global.set("name", project.name)
-        Global.set("version", "1")
-        self.Global = Global
+        if describe is None:
+            describe = project.describe()
+        self.name = describe["name"]
+        self.modified = describe.get("modified")
+        self.root = Folder("", "/")
         self.url_duration = url_duration
         self.genome = ref_genome
+        self.crawled = None
+        # the name of the output files, without extension. A registry may change this to keep them unique.
+        self.filename = self.name
+        # if set, then the renderers point at this caching proxy (see `serve_igvdata`), instead of at DNAnexus
+        self.proxy = None
+        # dict of file-id to the URL of a local copy, which the renderers point at instead (see `IgvRegistry.mirror`)
+        self.mirrors = {}
+
+    def __getstate__(self):
+        # the project handler is stored as its project-id, so a crawl can be stored without it, eg for a WorkQueue (see
+        # `dataset_to_json`)
+        state = dict(self.__dict__)
+        state["project"] = self.project.get_id()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.project = dxpy.DXProject(state["project"])
 
     def addData(self):
         """
         Recursively add all data within a DX project to this DxDataset instance, starting at top level
         """
-        self.addLevel(self.Global, "/")
+        # URLs are minted during the crawl, so they expire no earlier than `url_duration` after it starts
+        self.crawled = int(time.time())
+        self.root = Folder("", "/")
+        self.addLevel(self.root, "/")
+
+    def reindexFolder(self, path):
+        """
+        Re-crawl one folder, and everything beneath it, keeping the rest of a previous crawl. If the folder is new, then
+        its closest ancestor that was crawled before is re-crawled instead.
+        :param path: a folder within the project, eg "/run1/bams"
+        """
+        path = "/" + path.strip("/")
+        parent, node = None, self.root
+        for name in [name for name in path.split("/") if name]:
+            child = [folder for folder in node.folders if folder.name == name]
+            if not child:
+                break
+            parent, node = node, child[0]
+        if parent is None:
+            self.addData()
+            return
+        subnode = Folder(node.name, node.path)
+        self.addLevel(subnode, node.path)
+        parent.folders[parent.folders.index(node)] = subnode
 
     def addLevel(self, node, folder):
         """
         Recurse into folders, and find all IGV-compatible files to be added to registry
-        :param node: an Element, or SubElement to add items to
+        :param node: a Folder to add items to
         :param folder: a folder to find files within
-        :param debug: boolean. If True, then stop finding files after the first one.
         :return: nothing.
         """
         assert node is not None
         assert folder is not None
 
-        print("Adding {}:{}".format(self.project.name, folder))
+        print("Adding {}:{}".format(self.name, folder))
         subfolders = dxpy.api.project_list_folder(self.project.id, input_params={"folder": folder, "describe": {
             "fields": {"id": True, "name": True, "class": True}}, "only": "folders", "includeHidden": False},
                                                   always_retry=True)["folders"]
@@ -82,8 +265,9 @@ class DxDataset(object):
         subfolders = list(set(subfolders) - set(("metrics", "inputFastq", "reports")))
 
         for subfolder in subfolders:
-            subnode = SubElement(node, "Category", name=subfolder)
             subnodepath = str(folder + "/" + subfolder).replace("//", "/")
+            subnode = Folder(subfolder, subnodepath)
+            node.folders.append(subnode)
             self.addLevel(subnode, subnodepath)
 
         dxfiles = list(dxpy.find_data_objects(
@@ -109,14 +293,14 @@ class DxDataset(object):
 
     def __addIndexedFile(self, dxfile, folder, node, index_exts=["bai"]):
         """
-        Add a file to XML tree, which should also have an index file
+        Add a file to the folder tree, which should also have an index file
         :param dxfile: DXFile object, point to a BAM, or VCF file
         :param folder: folder in which to find the index file
-        :param node: Element or SubElement object
+        :param node: Folder object
         :param index_exts: an array of allowable file extensions of the index file. eg ['bai'], or ['idx', 'tbi']
         :return: nothing
         """
-        print("Adding {}:{}/{}".format(self.project.name, folder, dxfile.name))
+        print("Adding {}:{}/{}".format(self.name, folder, dxfile.name))
         assert isinstance(dxfile, dxpy.DXFile)
 
         name = str(dxfile.name).replace("gvcf.gz", "g.vcf.gz").replace("merged.dedup.realigned.", "")
@@ -145,10 +329,9 @@ class DxDataset(object):
             duration=self.url_duration, preauthenticated=True, filename=name
         )
 
-        resource = SubElement(node, "Resource")
-        resource.set("name", dxfile.name)
-        resource.set("path", file_url[0])
-        resource.set("index", indel_url[0])
+        resource_name = dxfile.name
+        coverage = None
+        tdf = None
         if "bai" in index_exts:
             # then look for TDF coverage file as well
             tdf = None
@@ -165,26 +348,30 @@ class DxDataset(object):
                 tdf_url = tdf.get_download_url(
                     duration=self.url_duration, preauthenticated=True, filename=tdf.name
                 )
-                resource.set("coverage", tdf_url[0])
-                resource.set("name", dxfile.name + " (+ tdf)")
-                # re-use this tdf URL, and add a separate element to the XML node
-                self.__addNonIndexedFile(tdf, folder=folder, node=node, file_url=tdf_url)
+                coverage = tdf_url[0]
+                resource_name = dxfile.name + TDF_SUFFIX
             else:
-                resource.set("coverage", ".")
-        if "tbi" in index_exts:
-            resource.set("mapping", ".")
+                coverage = "."
+        mapping = "." if "tbi" in index_exts else None
+
+        node.resources.append(Resource(dxfile.get_id(), resource_name, folder, file_url[0], index=indel_url[0],
+                                       coverage=coverage, mapping=mapping, index_id=index.get_id(),
+                                       coverage_id=tdf.get_id() if tdf else None))
+        if tdf:
+            # re-use this tdf URL, and add a separate Resource to the folder
+            self.__addNonIndexedFile(tdf, folder=folder, node=node, file_url=tdf_url)
 
     def __addNonIndexedFile(self, dxfile, folder, node, file_url=None):
         """
-        Add a file to XML tree, by generating a DX URL.
+        Add a file to the folder tree, by generating a DX URL.
         :param dxfile: DXFile object, point to a BAM, or VCF file
         :param folder: folder in which to find the index file
-        :param node: Element or SubElement object
+        :param node: Folder object
         :param file_url: If you've already created a download URL for a file, then supply the URL. This allows a URL to
         a coverage file (eg, TDF file) to be used both as a coverage file, and a stand-alone selectable file.
         :return: nothing
         """
-        print("Adding {}:{}/{}".format(self.project.name, folder, dxfile.name))
+        print("Adding {}:{}/{}".format(self.name, folder, dxfile.name))
         assert isinstance(dxfile, dxpy.DXFile)
 
         name = str(dxfile.name).replace("gvcf.gz", "g.vcf.gz").replace("merged.dedup.realigned.", "")
@@ -193,30 +380,228 @@ class DxDataset(object):
                 duration=self.url_duration, filename=name, preauthenticated=True
             )
 
-        resource = SubElement(node, "Resource")
-        resource.set("name", dxfile.name)
-        resource.set("path", file_url[0])
+        node.resources.append(Resource(dxfile.get_id(), dxfile.name, folder, file_url[0]))
+
+    def getPrewarmFiles(self):
+        """
+        :return: list of (file-id, URL, True if it's a TDF) of the files that IGV reads before it shows anything for a
+        track: every index, and every TDF coverage file. Each file is listed once.
+        """
+        files = {}
+        for resource in self.root.getResources():
+            if resource.index_id is not None:
+                files[resource.index_id] = (resource.index_id, resource.index, False)
+            if resource.coverage_id is not None:
+                files[resource.coverage_id] = (resource.coverage_id, resource.coverage, True)
+            elif file_name(resource).endswith(".tdf"):
+                files[resource.file_id] = (resource.file_id, resource.path, True)
+        return [files[file_id] for file_id in sorted(files)]
+
+    def getServedUrl(self, file_id, url):
+        """
+        :param file_id: the file-id, or None if the URL isn't of a DNAnexus file
+        :param url: the file's DNAnexus URL
+        :return: the URL that IGV should load a file from: its local mirror (see `mirrors`), `self.proxy` (keeping the
+        file name of its DNAnexus URL), or DNAnexus
+        """
+        if file_id is None:
+            return url
+        if file_id in self.mirrors:
+            return self.mirrors[file_id]
+        if self.proxy is not None:
+            return "{}/dx/{}/{}".format(self.proxy.rstrip("/"), file_id, url.rsplit("/", 1)[-1])
+        return url
+
+    def served(self, resource):
+        """:return: the Resource, with the URLs that IGV should load it from (see `getServedUrl`)"""
+        return resource._replace(path=self.getServedUrl(resource.file_id, resource.path),
+                                 index=self.getServedUrl(resource.index_id, resource.index),
+                                 coverage=self.getServedUrl(resource.coverage_id, resource.coverage))
+
+    def toXML(self):
+        """
+        Render the folder tree as an IGV dataset XML document.
+        :return: Element representing the Global node of the XML tree
+        """
+        Global = etree.Element('Global')
+        Global.set("name", self.name)
+        Global.set("version", "1")
+        self.__addXmlCategory(Global, self.root)
+        return Global
+
+    def __addXmlCategory(self, node, folder):
+        """
+        Render a Folder, and everything beneath it, within an XML node. Sub-folders become Category elements, and are
+        listed before the Resources in that folder.
+        :param node: Element or SubElement object
+        :param folder: Folder object
+        """
+        for subfolder in folder.folders:
+            self.__addXmlCategory(etree.SubElement(node, "Category", name=subfolder.name), subfolder)
+        for resource in folder.resources:
+            resource = self.served(resource)
+            element = etree.SubElement(node, "Resource")
+            element.set("name", resource.name)
+            element.set("path", resource.path)
+            if resource.index is not None:
+                element.set("index", resource.index)
+            if resource.coverage is not None:
+                element.set("coverage", resource.coverage)
+            if resource.mapping is not None:
+                element.set("mapping", resource.mapping)
+
+    def toIgvJs(self):
+        """
+        Render the folder tree as a list of igv.js track configurations.
+        :return: dict, with the genome id and the tracks, suitable for json.dump
+        """
+        tracks = []
+        for resource in map(self.served, self.root.getResources()):
+            track = {"name": resource.name, "url": resource.path}
+            for ext, settings in IGVJS_TRACK_TYPES:
+                if file_name(resource).endswith(ext):
+                    track.update(settings)
+                    break
+            if resource.index is not None:
+                track["indexURL"] = resource.index
+            tracks.append(track)
+        return {"name": self.name, "genome": IGVJS_GENOMES.get(self.genome, self.genome), "tracks": tracks}
+
+    def toSessions(self):
+        """
+        Render the folder tree as one IGV session per sample. A sample is only given a session if it has at least one
+        indexed file (ie a BAM or VCF). Files with the same sample name are grouped together, regardless of folder.
+        :return: dict of sample name to Element representing the Session node of each session XML
+        """
+        samples = {}
+        for resource in map(self.served, self.root.getResources()):
+            samples.setdefault(sample_name(resource), []).append(resource)
+
+        sessions = {}
+        for sample, resources in samples.items():
+            if not any(resource.index is not None for resource in resources):
+                continue
+            coverages = set(resource.coverage for resource in resources)
+            Session = etree.Element("Session", genome=self.genome, version="8")
+            Resources = etree.SubElement(Session, "Resources")
+            for resource in resources:
+                if resource.path in coverages:
+                    # already loaded as the coverage track of a BAM
+                    continue
+                element = etree.SubElement(Resources, "Resource", name=resource.name, path=resource.path)
+                if resource.index is not None:
+                    element.set("index", resource.index)
+                if resource.coverage not in (None, "."):
+                    element.set("coverage", resource.coverage)
+            sessions[sample] = Session
+        return sessions
 
     def getXmlPath(self, folder):
-        filename = self.project.name + ".xml"
+        filename = self.filename + ".xml"
+        return os.path.join(folder, filename)
+
+    def getJsonPath(self, folder):
+        filename = self.filename + ".json"
         return os.path.join(folder, filename)
 
+    def getSessionFolder(self, folder):
+        return os.path.join(folder, self.filename + ".sessions")
+
     def writeXML(self, folder):
         """
         Pretty print the XML tree.
         :return: str representing the path to the XML file
         """
         file_path = self.getXmlPath(folder)
-        rough_string = tostring(self.Global, 'utf-8', method="xml")
-        reparsed = xml.dom.minidom.parseString(rough_string)
+        rough_string = etree.tostring(self.toXML(), 'utf-8', method="xml")
+        reparsed = minidom.parseString(rough_string)
 
-        with open(file_path, "w") as text_file:
-            text_file.write(reparsed.toprettyxml(indent="\t", encoding='utf-8'))
+        atomic_write(file_path, reparsed.toprettyxml(indent="\t", encoding='utf-8'))
 
         # ElementTree(self.Global).write(filename, encoding="utf-8", xml_declaration=True)
         print("'%s' successfully created!" % file_path)
         return file_path
 
+    def writeJSON(self, folder):
+        """
+        Write the igv.js track configurations.
+        :return: str representing the path to the JSON file
+        """
+        file_path = self.getJsonPath(folder)
+        atomic_write(file_path, json.dumps(self.toIgvJs(), indent=2, separators=(",", ": "), sort_keys=True))
+        print("'%s' successfully created!" % file_path)
+        return file_path
+
+    def writeSessions(self, folder):
+        """
+        Write one IGV session XML file per sample, within a <project name>.sessions folder. The files are written
+        within a hidden temporary folder, which then replaces the old folder (see `replace_folder`), so a rebuild never
+        serves a half-written session, or a mix of old and new sessions.
+        :return: str representing the path to the folder of session files
+        """
+        session_folder = self.getSessionFolder(folder)
+        parent, name = os.path.split(session_folder)
+        tmp_folder = os.path.join(parent, ".{}.{}.tmp".format(name, os.getpid()))
+        os.mkdir(tmp_folder)
+        for sample, Session in self.toSessions().items():
+            rough_string = etree.tostring(Session, 'utf-8', method="xml")
+            reparsed = minidom.parseString(rough_string)
+            with open(os.path.join(tmp_folder, sample + ".xml"), "w") as text_file:
+                text_file.write(reparsed.toprettyxml(indent="\t", encoding='utf-8'))
+        replace_folder(tmp_folder, session_folder)
+        print("'%s' successfully created!" % session_folder)
+        return session_folder
+
+    def write(self, folder, formats=("xml",)):
+        """
+        Render the same crawl, with the same URLs, to each of the requested output formats.
+        :param folder: folder to write the output files within
+        :param formats: any of OUTPUT_FORMATS
+        :return: dict of format to the path that was written
+        """
+        writers = {"xml": self.writeXML, "json": self.writeJSON, "session": self.writeSessions}
+        return dict((fmt, writers[fmt](folder)) for fmt in formats)
+
+
+def resolve_projects(projects):
+    """
+    Resolve any number of project names or project-id's to project-id's, and describe them, using one
+    `find_projects` call rather than one lookup per project. Unknown, or ambiguous, project names are skipped.
+    :param projects: list of project names, or project-id's
+    :return: (list of project-id's, in the same order as `projects`, dict of project-id to the project's description)
+    """
+    describes = {}
+    by_name = {}
+    for project in dxpy.find_projects(describe={"fields": {"name": True, "modified": True}}):
+        describes[project["id"]] = project["describe"]
+        by_name.setdefault(project["describe"]["name"], []).append(project["id"])
+
+    project_ids = []
+    for project in projects:
+        if project.startswith("project-"):
+            project_ids.append(project)
+        elif len(by_name.get(project, [])) == 1:
+            project_ids.append(by_name[project][0])
+        elif project in by_name:
+            print("Skipping {}, as {} projects have that name: {}".format(
+                project, len(by_name[project]), ", ".join(by_name[project])))
+        else:
+            print("Skipping {}, as no project has that name".format(project))
+    return project_ids, describes
+
+
+def read_projects(path):
+    """
+    Read project names or project-id's, one per line, from a file, or from stdin if `path` is '-'. Blank lines and
+    lines starting with '#' are ignored.
+    """
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r") as projects_file:
+            lines = projects_file.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
 
 def touch(path):
     """
@@ -225,12 +610,409 @@ def touch(path):
     with open(path, 'a'):
         os.utime(path, None)
 
+
+def replace_folder(src, dst):
+    """
+    Rename the folder `src` to `dst`, replacing any folder that is already there. Folders can't be renamed over one
+    another, so the old folder is first renamed aside, and removed once `src` is in place. `dst` is missing between
+    the two renames, but never holds a mix of old and new files.
+    """
+    if os.path.exists(dst):
+        parent, name = os.path.split(dst)
+        old = os.path.join(parent, ".{}.{}.old".format(name, os.getpid()))
+        os.rename(dst, old)
+        os.rename(src, dst)
+        shutil.rmtree(old)
+    else:
+        os.rename(src, dst)
+
+
+def atomic_write(path, data):
+    """
+    Write `data` to a temporary file next to `path`, then rename it over `path`. Readers see either the old file, or
+    the new file, but never a partially written one.
+    """
+    tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, "w") as tmp_file:
+        tmp_file.write(data)
+    os.rename(tmp_path, path)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive advisory lock on `path` (created if necessary), blocking until the lock is available. This lets
+    several dx-igv-registry.py processes modify the same registry at once.
+    """
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class Progress(object):
+    """
+    Report progress through a run of projects, with an estimate of the time remaining.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+
+    def update(self, name):
+        self.done += 1
+        elapsed = time.time() - self.start
+        remaining = elapsed / self.done * (self.total - self.done)
+        print("[{}/{}] Finished {}. Elapsed {:.0f}s, about {:.0f}s remaining".format(
+            self.done, self.total, name, elapsed, remaining))
+
+
+def makedirs(path):
+    """
+    Create a folder and any missing parents, unless it already exists (eg because another process just created it).
+    :return: True if the folder was created
+    """
+    try:
+        os.makedirs(path)
+        return True
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+
+
+def make_private_folder(path):
+    """
+    Create a folder, if it doesn't exist, with an .htaccess file that denies all web access, eg for files that hold
+    pre-authenticated URLs but aren't meant for IGV.
+    """
+    makedirs(path)
+    htaccess_path = os.path.join(path, ".htaccess")
+    if not os.path.exists(htaccess_path):
+        atomic_write(htaccess_path, "Require all denied\n")
+
+
+class RegistryState(object):
+    """
+    The local state of every IgvRegistry within an igvdata root, stored in one embedded SQLite database. It records
+    the DX projects, folders and files that have been crawled, the URLs minted for each file and when they expire, and
+    the manifests written for each registry along with a hash of their content.
+
+    A registry is identified by its group and ref_genome, eg "LKCGP/1kg_v37", or "/1kg_v37" if it has no group. The
+    manifests of a shared registry live in a store (eg "_shared/0a1b2c3d4e5f"), which is shared by every registry with
+    the same settings, and its manifests rows are the mapping of projects to the groups that can see them.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS projects (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            modified INTEGER,
+            crawled INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS projects_name ON projects (name);
+        CREATE TABLE IF NOT EXISTS folders (
+            project_id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (project_id, path)
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (project_id, id)
+        );
+        CREATE INDEX IF NOT EXISTS files_project_folder ON files (project_id, folder);
+        CREATE INDEX IF NOT EXISTS files_id ON files (id);
+        CREATE TABLE IF NOT EXISTS urls (
+            file_id TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            expires INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS urls_expires ON urls (expires);
+        CREATE TABLE IF NOT EXISTS manifests (
+            registry TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            written INTEGER NOT NULL,
+            modified INTEGER,
+            fingerprint TEXT,
+            expires INTEGER,
+            dataset BLOB,
+            PRIMARY KEY (registry, project_id)
+        );
+        CREATE INDEX IF NOT EXISTS manifests_path ON manifests (registry, path);
+        CREATE TABLE IF NOT EXISTS registries (
+            name TEXT PRIMARY KEY,
+            grp TEXT,
+            ref_genome TEXT NOT NULL,
+            url_root TEXT NOT NULL,
+            url_duration INTEGER NOT NULL,
+            formats TEXT NOT NULL,
+            tag TEXT,
+            store TEXT,
+            proxy TEXT,
+            prewarm INTEGER,
+            mirror_under INTEGER,
+            bai_coverage INTEGER
+        );
+    """
+
+    def __init__(self, igvdata_path):
+        """
+        :param igvdata_path: the igvdata root. The database lives in a hidden .state folder within it, which is
+        protected from the web by an .htaccess file, as it holds pre-authenticated URLs.
+        """
+        state_folder = os.path.join(igvdata_path, ".state")
+        make_private_folder(state_folder)
+        self.root = igvdata_path
+        self.path = os.path.join(state_folder, "registry.sqlite")
+        # a generous timeout, as other dx-igv-registry.py processes may be writing to the same database
+        self.db = sqlite3.connect(self.path, timeout=300)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def recordDataset(self, dataset):
+        """
+        Record a crawled DxDataset: the project, its folders, its files, and the URLs that were minted for them. This
+        replaces whatever was known about the project's folders and files before.
+        :param dataset: DxDataset, after `addData`
+        """
+        project_id = dataset.project.get_id()
+        expires = dataset.crawled + dataset.url_duration
+        resources = dataset.root.getResources()
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO projects (id, name) VALUES (?, ?)", (project_id, dataset.name))
+            self.db.execute("UPDATE projects SET name = ?, crawled = ?, modified = coalesce(?, modified) WHERE id = ?",
+                            (dataset.name, dataset.crawled, dataset.modified, project_id))
+            self.db.execute("DELETE FROM folders WHERE project_id = ?", (project_id,))
+            self.db.executemany("INSERT INTO folders (project_id, path) VALUES (?, ?)",
+                                ((project_id, folder.path) for folder in dataset.root.walk()))
+            self.db.execute("DELETE FROM files WHERE project_id = ?", (project_id,))
+            # resources without a file-id (eg derived coverage, see `IgvRegistry.addBaiCoverage`) aren't DNAnexus files
+            resources = [resource for resource in resources if resource.file_id is not None]
+            self.db.executemany("INSERT OR REPLACE INTO files (id, project_id, folder, name) VALUES (?, ?, ?, ?)",
+                                ((resource.file_id, project_id, resource.folder, resource.name)
+                                 for resource in resources))
+            urls = [(resource.file_id, resource.path, expires) for resource in resources]
+            urls.extend((resource.index_id, resource.index, expires) for resource in resources
+                        if resource.index_id is not None)
+            self.db.executemany("INSERT OR REPLACE INTO urls (file_id, url, expires) VALUES (?, ?, ?)", urls)
+
+    def recordManifest(self, registry, project_id, path, modified=None, fingerprint=None, expires=None, dataset=None):
+        """
+        Record that a manifest was successfully written for a project within a registry.
+        :param registry: the registry's name, eg "LKCGP/1kg_v37"
+        :param project_id: the DX project-id
+        :param path: path to the XML manifest. Only its file name is recorded.
+        :param modified: the project's DNAnexus modification time, when it was crawled
+        :param fingerprint: the registry's crawl fingerprint, see `IgvRegistry.fingerprint`
+        :param expires: the time at which the soonest expiring URL within the manifest expires
+        :param dataset: the DxDataset that the manifest was rendered from, which is kept so that parts of the project
+        can be re-crawled later (see `IgvRegistry.reindex`)
+        """
+        with open(path, "rb") as manifest:
+            digest = hashlib.sha1(manifest.read()).hexdigest()
+        blob = sqlite3.Binary(pickle.dumps(dataset, 2)) if dataset is not None else None
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO manifests (registry, project_id, path, hash, written, modified, "
+                            "fingerprint, expires, dataset) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (registry, project_id, os.path.basename(path), digest, int(time.time()), modified,
+                             fingerprint, expires, blob))
+
+    def getDataset(self, registry, project_id):
+        """:return: the DxDataset that a project's manifest within a registry was rendered from, or None"""
+        row = self.db.execute("SELECT dataset FROM manifests WHERE registry = ? AND project_id = ?",
+                              (registry, project_id)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def getBuilds(self, registry):
+        """
+        :return: dict of project-id to the (modified, fingerprint, expires) of its last successful build within a
+        registry
+        """
+        return dict((row[0], tuple(row[1:])) for row in self.db.execute(
+            "SELECT project_id, modified, fingerprint, expires FROM manifests WHERE registry = ?", (registry,)))
+
+    def forgetBuilds(self, registry):
+        """
+        Forget how the manifests within a registry were built, eg once an older generation has been restored, so that
+        `IgvRegistry.needsBuild` rebuilds them all, and `IgvRegistry.reindex` re-crawls them in full.
+        """
+        with self.db:
+            self.db.execute("UPDATE manifests SET modified = NULL, fingerprint = NULL, expires = NULL, dataset = NULL "
+                            "WHERE registry = ?", (registry,))
+
+    def recordRegistry(self, registry):
+        """Record the settings of an IgvRegistry, so that it can be recreated later, eg by `serve_updates`."""
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO registries (name, ref_genome, url_root, url_duration, formats) "
+                            "VALUES (?, ?, ?, ?, ?)", (registry.name, registry.ref_genome, "", 0, ""))
+            self.db.execute("UPDATE registries SET grp = ?, ref_genome = ?, url_root = ?, url_duration = ?, "
+                            "formats = ?, store = ?, proxy = ?, prewarm = ?, mirror_under = ?, bai_coverage = ? "
+                            "WHERE name = ?",
+                            (registry.group, registry.ref_genome, registry.root_url, registry.url_duration,
+                             ",".join(registry.formats), registry.store, registry.proxy, int(registry.prewarm),
+                             registry.mirror_under, int(registry.bai_coverage), registry.name))
+
+    def setRegistryTag(self, registry, tag):
+        """Record the DNAnexus tag that a registry is synced with (see `IgvRegistry.syncTag`)."""
+        with self.db:
+            self.db.execute("UPDATE registries SET tag = ? WHERE name = ?", (tag, registry))
+
+    def getManifestExpiry(self, folder, path):
+        """
+        :param folder: the folder of the manifest, relative to the igvdata root: a registry group, "" for registries
+        without a group, or a shared store
+        :param path: the file name of a manifest
+        :return: the time at which the soonest expiring URL within a manifest expires, or None if it's not known
+        """
+        return self.db.execute("SELECT min(m.expires) FROM manifests m JOIN registries r ON r.name = m.registry "
+                               "WHERE coalesce(r.store, r.grp, '') = ? AND m.path = ?", (folder, path)).fetchone()[0]
+
+    def getRegistryTag(self, registry):
+        row = self.db.execute("SELECT tag FROM registries WHERE name = ?", (registry,)).fetchone()
+        return row[0] if row else None
+
+    def getRegistries(self):
+        """
+        :return: list of (group, ref_genome, url_root, url_duration, formats, store, proxy, prewarm, mirror_under,
+        bai_coverage) for each registry
+        """
+        return self.db.execute("SELECT grp, ref_genome, url_root, url_duration, formats, store, proxy, prewarm, "
+                               "mirror_under, bai_coverage FROM registries ORDER BY name").fetchall()
+
+    def getRegistry(self, registry):
+        """:return: the recorded settings of a registry, as for `getRegistries`, or None if it isn't known"""
+        return self.db.execute("SELECT grp, ref_genome, url_root, url_duration, formats, store, proxy, prewarm, "
+                               "mirror_under, bai_coverage FROM registries WHERE name = ?", (registry,)).fetchone()
+
+    def getManifestOwner(self, registry, path, store=None):
+        """
+        :param store: if set, look for the manifest within every registry in this shared store, instead of `registry`
+        :return: the project-id whose manifest within a registry has this file name, or None
+        """
+        if store is not None:
+            row = self.db.execute("SELECT m.project_id FROM manifests m JOIN registries r ON r.name = m.registry "
+                                  "WHERE r.store = ? AND m.path = ?", (store, os.path.basename(path))).fetchone()
+        else:
+            row = self.db.execute("SELECT project_id FROM manifests WHERE registry = ? AND path = ?",
+                                  (registry, os.path.basename(path))).fetchone()
+        return row[0] if row else None
+
+    def countManifestUsers(self, store, path):
+        """:return: the number of registries whose manifests within a shared store include this file"""
+        return self.db.execute("SELECT count(*) FROM manifests m JOIN registries r ON r.name = m.registry "
+                               "WHERE r.store = ? AND m.path = ?", (store, os.path.basename(path))).fetchone()[0]
+
+    def getStoreBuilds(self, store):
+        """
+        :return: dict of project-id to the (modified, fingerprint, expires) of its latest build within any registry in
+        a shared store
+        """
+        return dict((row[0], tuple(row[1:])) for row in self.db.execute(
+            "SELECT m.project_id, m.modified, m.fingerprint, m.expires FROM manifests m "
+            "JOIN registries r ON r.name = m.registry WHERE r.store = ? ORDER BY m.written", (store,)))
+
+    def linkManifest(self, store, registry, project_id):
+        """
+        Add a project to a shared registry, using the latest manifest already built for it by another registry in the
+        same store.
+        :return: the manifest's file name
+        """
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO manifests (registry, project_id, path, hash, written, modified, "
+                            "fingerprint, expires, dataset) "
+                            "SELECT ?, m.project_id, m.path, m.hash, m.written, m.modified, m.fingerprint, m.expires, "
+                            "m.dataset FROM manifests m JOIN registries r ON r.name = m.registry "
+                            "WHERE r.store = ? AND m.project_id = ? ORDER BY m.written DESC LIMIT 1",
+                            (registry, store, project_id))
+        return self.db.execute("SELECT path FROM manifests WHERE registry = ? AND project_id = ?",
+                               (registry, project_id)).fetchone()[0]
+
+    def getSharedRegistry(self, registry):
+        """
+        :param registry: the registry's name, eg "LKCGP/1kg_v37"
+        :return: (url_root, store, list of (manifest file name, written)) for a shared registry, or None if the
+        registry isn't shared
+        """
+        row = self.db.execute("SELECT url_root, store FROM registries WHERE name = ? AND store IS NOT NULL",
+                              (registry,)).fetchone()
+        if row is None:
+            return None
+        manifests = self.db.execute("SELECT path, written FROM manifests WHERE registry = ? ORDER BY path",
+                                    (registry,)).fetchall()
+        return row[0], row[1], manifests
+
+    def forgetManifest(self, registry, project_id):
+        with self.db:
+            self.db.execute("DELETE FROM manifests WHERE registry = ? AND project_id = ?", (registry, project_id))
+
+    def getManifests(self, registry):
+        """:return: list of (project_id, project name, manifest file name, hash, written) within a registry"""
+        return self.db.execute("SELECT m.project_id, p.name, m.path, m.hash, m.written FROM manifests m "
+                               "LEFT JOIN projects p ON p.id = m.project_id WHERE m.registry = ? ORDER BY p.name",
+                               (registry,)).fetchall()
+
+    def getFolderFileIds(self, folder):
+        """
+        :param folder: a folder of manifests, relative to the igvdata root (see `getManifestExpiry`)
+        :return: set of the file-id's within every project that has a manifest within the folder
+        """
+        return set(row[0] for row in self.db.execute(
+            "SELECT f.id FROM files f JOIN manifests m ON m.project_id = f.project_id "
+            "JOIN registries r ON r.name = m.registry WHERE coalesce(r.store, r.grp, '') = ?", (folder,)))
+
+    def getUrl(self, file_id):
+        """:return: the pre-authenticated URL minted for a file, or None if there is none that hasn't expired"""
+        row = self.db.execute("SELECT url FROM urls WHERE file_id = ? AND expires > ?",
+                              (file_id, int(time.time()))).fetchone()
+        return row[0] if row else None
+
+    def getFileGroup(self, file_id):
+        """
+        :return: the group of the first registry (by group name) with a manifest of the project holding a file, or
+        None if the file isn't within any registry's projects, or those registries have no group
+        """
+        row = self.db.execute(
+            "SELECT r.grp FROM files f JOIN manifests m ON m.project_id = f.project_id "
+            "JOIN registries r ON r.name = m.registry WHERE f.id = ? AND r.grp IS NOT NULL ORDER BY r.grp LIMIT 1",
+            (file_id,)).fetchone()
+        return row[0] if row else None
+
+    def getProjectExpiry(self, project_id):
+        """:return: the time at which the soonest expiring URL within a project expires, or None"""
+        return self.db.execute("SELECT min(u.expires) FROM files f JOIN urls u ON u.file_id = f.id "
+                               "WHERE f.project_id = ?", (project_id,)).fetchone()[0]
+
+    def countFiles(self, project_id):
+        return self.db.execute("SELECT count(*) FROM files WHERE project_id = ?", (project_id,)).fetchone()[0]
+
+
 class IgvRegistry(object):
     def __init__(self, ref_genome="1kg_v37",
                  folder=os.path.join(os.path.expanduser('~'), "igvdata"),
                  url_root='http://localhost:8000/igvdata',
                  url_duration=ONE_YEAR,
-                 group=None):
+                 group=None,
+                 formats=("xml",),
+                 flush_every=None,
+                 jobs=1,
+                 refresh_within=None,
+                 shared=False,
+                 proxy=None,
+                 prewarm=False,
+                 mirror_under=None,
+                 bai_coverage=False,
+                 record=True):
         """
         An IgvRegistry is a TXT file, pointing to XML files representing Datasets to be loaded into IGV.
         The TXT file lives on a web server (within `folder`), and is accessible via a url (`url_root` + TXT).
@@ -245,14 +1027,70 @@ class IgvRegistry(object):
         :param group: Group represents a way to share data with a specific research group. Eg LKCGP. if group is specified,
         then the XML and TXT registry files will be found within url_root + group. The first time that a group is made,
         an .htaccess file is made
+        :param formats: output formats to write for each project, from OUTPUT_FORMATS. The XML format is always written,
+        as that is what the registry points to.
+        :param flush_every: by default, new registry entries are written to the TXT file once, at the end of
+        `addProjects`. Set this to N to also write them after every N projects, eg for very long runs.
+        :param jobs: the number of projects to crawl at once
+        :param refresh_within: if set, then updates also rebuild projects whose URLs expire within this many seconds
+        :param shared: if True, then the manifests are kept in a store shared by every registry with the same settings
+        (within igvdata/_shared), so a project that several groups can see is crawled and stored once. The local state
+        records which projects each group has, and `serve_igvdata` builds the group's registry TXT from it on request,
+        so no TXT is written. A shared store's .htaccess denies all web access, so it's meant to be served with
+        `serve_igvdata`, which has no per-group access control.
+        :param proxy: if set, then manifests point at the caching proxy of `serve_igvdata` at this URL (eg
+        http://localhost:8000), rather than at DNAnexus
+        :param prewarm: if True, then once each project's manifests are written, the files that IGV reads first (every
+        index, and the low zoom levels of every TDF) are fetched into the proxy's cache, in the background. This needs
+        a `proxy` that serves this igvdata root.
+        :param mirror_under: if set, then track files that IGV loads whole (see MIRRORED_EXTENSIONS) that are smaller
+        than this many bytes are copied into the registry's _mirror folder, and the manifests point at the copies
+        :param bai_coverage: if True, then BAMs without a TDF are given a coverage track derived from their BAI, see
+        `addBaiCoverage`
+        :param record: whether to record these settings in the local state. Read-only commands (eg --report) should
+        open the registry with its recorded settings instead, see `open_registry`.
+        :raise ValueError: if the registry was built with settings that put its manifests in another folder (ie with or
+        without `shared`, or with other settings of a shared store)
         """
         self.group = group
+        self.formats = ("xml",) + tuple(fmt for fmt in formats if fmt != "xml")
         self.ref_genome = ref_genome
         self.txt = self.ref_genome + "_dataServerRegistry.txt"
         self.url_duration = url_duration
+        self.flush_every = flush_every
+        self.jobs = jobs
+        self.refresh_within = refresh_within
+        self.proxy = proxy
+        self.prewarm = prewarm
+        self.cache = BlockCache(os.path.join(folder, ".cache")) if prewarm else None
+        self.prewarming = None
+        self.mirror_under = mirror_under
+        self.bai_coverage = bai_coverage
+        # set this Event to stop `addProjects` after the current project, eg on shutdown
+        self.stop = threading.Event()
+        self.root_folder = folder
+        self.root_url = url_root
+        # if set to a WorkQueue, then `addProjects` has the queue's workers crawl projects, instead of this process
+        self.queue = None
+        self.pending = set()
+        self.removed = set()
         
+        self.name = "{}/{}".format(self.group or "", self.ref_genome)
+        # the settings that shape a build. If these change, then every project needs rebuilding, even if unmodified.
+        self.fingerprint = hashlib.sha1("{}|{}|{}{}{}{}".format(
+            self.ref_genome, self.url_duration, ",".join(sorted(self.formats)),
+            "|" + self.proxy if self.proxy else "",
+            "|mirror<{}".format(self.mirror_under) if self.mirror_under else "",
+            "|bai_coverage" if self.bai_coverage else "").encode("utf-8")).hexdigest()
+        # registries share a store only if their manifests would be identical
+        self.store = "{}/{}".format(SHARED_FOLDER, self.fingerprint[:12]) if shared else None
+
         if self.group:
             assert self.group == quote(self.group)
+        if self.store:
+            self.folder = os.path.join(folder, self.store)
+            self.url_root = os.path.join(url_root, self.store)
+        elif self.group:
             self.folder = os.path.join(folder, group)
             self.url_root = os.path.join(url_root, group)
         else:
@@ -260,24 +1098,48 @@ class IgvRegistry(object):
             self.url_root = url_root
         
         self.path = os.path.join(self.folder, self.txt)
+        self.lock_path = os.path.join(self.folder, "." + self.txt + ".lock")
+        # outside of `listGeneration`, so mirrored files are kept when a new generation is promoted
+        self.mirror_folder = os.path.join(self.folder, MIRROR_FOLDER)
+        self.coverage_folder = os.path.join(self.folder, COVERAGE_FOLDER)
+        self.state = RegistryState(folder)
+        recorded = self.state.getRegistry(self.name)
+        if recorded is not None and recorded[5] != self.store and self.state.getManifests(self.name):
+            self.state.close()
+            raise ValueError("{} was built within {}, but these settings would move it to {}. Give the --shared, "
+                             "--proxy, --mirror_under and --bai_coverage that it was built with.".format(
+                                 self.name, recorded[5] or recorded[0] or "the igvdata root",
+                                 self.store or self.group or "the igvdata root"))
         self.initialise_folder()
+        if record:
+            self.state.recordRegistry(self)
         
-        self.projects = []
+        self.projects = {}
+        self.legacy = set()
         self.updateCache()
 
     def initialise_folder(self):
         """
         initialise an IgvRegistry folder. it will create an .htaccess file
         """
-        if not os.path.exists(self.folder):
+        if makedirs(self.folder):
             print("Initialising " + self.folder)
-            os.mkdir(self.folder)
-            self.write_htaccess_file()
+            if self.group and not self.store:
+                self.write_htaccess_file()
+        if self.store:
+            # groups share the store, so Apache can't give it any one group's password. It's denied to the web, and
+            # served by serve_igvdata, which builds the registry TXT on request
+            make_private_folder(self.folder)
+            return
         touch(self.path)
         if self.ref_genome == "1kg_v37":
             for alias in ("hg19", "b37"):
-                if not os.path.exists(self.path.replace(self.ref_genome, alias)):
-                    os.symlink(self.path, self.path.replace(self.ref_genome, alias))
+                if not os.path.lexists(self.path.replace(self.ref_genome, alias)):
+                    try:
+                        os.symlink(self.path, self.path.replace(self.ref_genome, alias))
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
 
     def write_htaccess_file(self):
         assert self.group is not None
@@ -307,140 +1169,2339 @@ class IgvRegistry(object):
         
 
     def updateCache(self):
-        manifests = []
-        os.chdir(self.folder)
-        for file in glob.glob("*.xml"):
-            manifests.append(str(file).replace(".xml", ""))
-        self.projects = manifests
+        """
+        Load the registry's manifests from the local state, as a dict of project-id to manifest file name. Manifests
+        whose file has since been removed are forgotten. XML files that pre-date the local state are only known by
+        their project name, and are kept in `self.legacy`.
+        """
+        projects = {}
+        missing = []
+        manifests = self.state.getManifests(self.name)
+        for project_id, name, path, digest, written in manifests:
+            if os.path.exists(os.path.join(self.folder, path)):
+                projects[project_id] = path
+            else:
+                missing.append(project_id)
+        if missing and len(missing) == len(manifests):
+            # more likely the wrong folder than every manifest deleted, so keep the state
+            print("None of the {} manifests of {} are within {}, so they're kept in the local state".format(
+                len(manifests), self.name, self.folder))
+        else:
+            for project_id in missing:
+                self.state.forgetManifest(self.name, project_id)
+        known = set(projects.values())
+        self.projects = projects
+        if self.store:
+            # the other manifests within a shared store belong to other registries
+            self.legacy = set()
+            return
+        self.legacy = set(name[:-len(".xml")] for name in os.listdir(self.folder)
+                          if name.endswith(".xml") and name not in known)
 
     def getProjects(self):
-        return self.projects
+        """:return: list of the project-id's within the registry, plus the names of any legacy manifests"""
+        return list(self.projects) + sorted(self.legacy)
+
+    def getManifestName(self, project_id, name):
+        """
+        Choose the file name for a project's manifests, which is normally the project name. If another project with the
+        same name already has that file, then the project-id is added, eg "Test.project-B0000000000000000000000.xml".
+        :return: file name, without an extension
+        """
+        filename = name
+        owner = self.state.getManifestOwner(self.name, filename + ".xml", store=self.store)
+        if owner is not None and owner != project_id:
+            filename = "{}.{}".format(name, project_id)
+        return filename
+
+    def getManifestUrl(self, xml_path):
+        """:return: the web accessible URL to an XML manifest within this registry"""
+        xml_relative_path = xml_path.replace(self.folder, '')
+        #print("registry root path: {}\nxml_path: {}\nxml_relative_path: {}\nurl_root: {}".format(self.folder, xml_path, xml_relative_path, self.url_root))
+        url = self.url_root + xml_relative_path
+        return quote(url, safe=URL_SAFE)
+
+    def removeManifests(self, filename):
+        """
+        Remove the manifests with this file name (without extension), in every format, and queue its URL for removal
+        from the registry TXT. Manifests within a shared store are kept while any other registry still uses them.
+        """
+        xml_path = os.path.join(self.folder, filename + ".xml")
+        print("Removing {} from registry at {}".format(xml_path, self.path))
+        self.removed.add(self.getManifestUrl(xml_path))
+        if self.store and self.state.countManifestUsers(self.store, xml_path):
+            return
+        for path in (xml_path, os.path.join(self.folder, filename + ".json")):
+            if os.path.exists(path):
+                os.unlink(path)
+        if os.path.exists(os.path.join(self.folder, filename + ".sessions")):
+            shutil.rmtree(os.path.join(self.folder, filename + ".sessions"))
 
-    def addProjects(self, project_ids):
+    def addProjects(self, project_ids, describes=None):
         """
         The main workhorse function. For a given list of project_ids, create an XML manifest for each, and add them to
         the registry.
         :param project_ids: list of project-id's, either by their name, or their project-id
+        :param describes: optional dict of project-id to the project's description, if already known
         """
-        for project_id in project_ids:
-            dx_project = DxDataset(project=project_id, ref_genome=self.ref_genome, url_duration=self.url_duration)
+        describes = describes or {}
+        project_ids = list(project_ids)
+        if self.store:
+            project_ids = self.linkSharedManifests(project_ids, describes)
+
+        def crawl(project_id):
+            dx_project = DxDataset(project=project_id, ref_genome=self.ref_genome, url_duration=self.url_duration,
+                                   describe=describes.get(project_id))
             dx_project.addData()
-            xml_path = dx_project.writeXML(self.folder)
-            self.addDxDataset(dx_project.project, xml_path)
+            return dx_project
+
+        # crawls spend most of their time waiting on DNAnexus, so run them in threads. Their results are written to the
+        # registry by this thread, as each one finishes.
+        pool = None
+        if self.queue is not None:
+            # crawled by workers, possibly on other hosts; see run_worker
+            datasets = self.queue.map(project_ids, self.ref_genome, self.url_duration, describes, self.stop)
+        elif self.jobs > 1 and len(project_ids) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.jobs, len(project_ids)))
+            datasets = pool.imap_unordered(crawl, project_ids)
+        else:
+            datasets = (crawl(project_id) for project_id in project_ids)
+
+        progress = Progress(len(project_ids))
+        try:
+            for i, dx_project in enumerate(datasets):
+                self.addCrawledDataset(dx_project)
+                if self.stop.is_set():
+                    print("Stopping, after {} of {} projects".format(i + 1, len(project_ids)))
+                    break
+                progress.update(dx_project.name)
+                if self.flush_every and (i + 1) % self.flush_every == 0:
+                    self.flushRegistry()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            # register whatever was completed, even if a later project failed
+            self.flushRegistry()
+            self.finishPrewarming()
+            if self.mirror_under or self.bai_coverage:
+                self.expireMirrors()
+
+    def linkSharedManifests(self, project_ids, describes):
+        """
+        Add the projects whose manifest within the shared store is already up to date (eg because another group has
+        built it), without crawling them again.
+        :param project_ids: list of project-id's
+        :param describes: dict of project-id to the project's description. Projects that aren't described are looked
+        up, with one `find_projects` call.
+        :return: list of the project-id's that still need to be crawled
+        """
+        builds = self.state.getStoreBuilds(self.store)
+        candidates = [project_id for project_id in project_ids if project_id in builds]
+        if any(project_id not in describes for project_id in candidates):
+            describes = dict(describes)
+            describes.update(resolve_projects([project_id for project_id in candidates
+                                               if project_id not in describes])[1])
+        remaining = []
+        for project_id in project_ids:
+            describe = describes.get(project_id)
+            if project_id not in builds or describe is None or self.isStale(builds[project_id], describe):
+                remaining.append(project_id)
+                continue
+            previous = self.projects.get(project_id)
+            self.projects[project_id] = self.state.linkManifest(self.store, self.name, project_id)
+            if previous is not None and previous != self.projects[project_id]:
+                self.removeManifests(previous[:-len(".xml")])
+            print("Using the shared manifest for {} ({})".format(describe["name"], project_id))
+        return remaining
+
+    def addCrawledDataset(self, dx_project):
+        """
+        Write the manifests for a crawled DxDataset, record it in the local state, and queue it for the registry TXT.
+        :param dx_project: DxDataset, after `addData`
+        """
+        project_id = dx_project.project.get_id()
+        if self.mirror_under:
+            self.mirror(dx_project)
+        if self.bai_coverage:
+            self.addBaiCoverage(dx_project)
+        with file_lock(self.lock_path):
+            dx_project.filename = self.getManifestName(project_id, dx_project.name)
+            dx_project.proxy = self.proxy
+            xml_path = dx_project.write(self.folder, self.formats)["xml"]
+            self.state.recordManifest(self.name, project_id, xml_path, modified=dx_project.modified,
+                                      fingerprint=self.fingerprint,
+                                      expires=dx_project.crawled + dx_project.url_duration, dataset=dx_project)
+        previous = self.projects.get(project_id)
+        if previous is not None and previous != os.path.basename(xml_path):
+            # the project has been renamed since its last manifest was written
+            self.removeManifests(previous[:-len(".xml")])
+        self.state.recordDataset(dx_project)
+        self.addDxDataset(dx_project.project, xml_path)
+        if self.prewarm:
+            self.prewarmDataset(dx_project)
+
+    def mirror(self, dx_project):
+        """
+        Copy the small track files of a DxDataset that IGV loads whole (see MIRRORED_EXTENSIONS, and `mirror_under`)
+        into the registry's _mirror folder, as _mirror/<file-id>/<file name>, and point its manifests at the copies.
+        DNAnexus files never change, so a file that has already been mirrored isn't copied again. A file that changes
+        on DNAnexus gets a new file-id, and its old copy is removed by `expireMirrors`.
+        """
+        mirrors = {}
+        for resource in dx_project.root.getResources():
+            if resource.index is not None or not file_name(resource).endswith(MIRRORED_EXTENSIONS):
+                continue
+            name = resource.path.rsplit("/", 1)[-1]
+            path = os.path.join(self.mirror_folder, resource.file_id, unquote(name))
+            if not os.path.exists(path):
+                try:
+                    data = fetch_file(resource.path, max_size=self.mirror_under - 1)
+                except IOError as e:
+                    print("Couldn't mirror {}: {}".format(resource.name, e))
+                    continue
+                if data is None:
+                    continue
+                makedirs(os.path.dirname(path))
+                atomic_write(path, data)
+                print("Mirrored {} ({} bytes) to {}".format(resource.name, len(data), path))
+            mirrors[resource.file_id] = quote("{}/{}/{}/{}".format(
+                self.url_root.rstrip("/"), MIRROR_FOLDER, resource.file_id, unquote(name)), safe=URL_SAFE)
+        dx_project.mirrors = mirrors
+
+    def addBaiCoverage(self, dx_project):
+        """
+        Give each BAM of a DxDataset that has no TDF a low resolution coverage track, derived from its BAI (see
+        `bai_coverage`), without downloading any reads. The track is written as a bedGraph in the registry's _coverage
+        folder, as _coverage/<BAM file-id>/<BAM name>.bedgraph, and is only derived once per BAM. IGV only reads a TDF
+        as a BAM's coverage, so the bedGraph is added as a Resource of its own, next to the BAM (as a TDF is, see
+        `DxDataset.__addIndexedFile`), and the BAM keeps coverage="." so that IGV doesn't look for a TDF.
+        """
+        for folder in dx_project.root.walk():
+            derived = set(resource.name for resource in folder.resources if resource.file_id is None)
+            for resource in list(folder.resources):
+                name = file_name(resource) + ".bedgraph"
+                if resource.coverage != "." or not file_name(resource).endswith(".bam") or name in derived:
+                    continue
+                path = os.path.join(self.coverage_folder, resource.file_id, name)
+                if not os.path.exists(path):
+                    try:
+                        names = bam_reference_names(lambda start, end: fetch_range(resource.path, start, end)[0])
+                        windows = bai_coverage(fetch_file(resource.index), names)
+                        lines = ["track type=bedGraph name=\"{} (approximate reads per 16kb)\"\n".format(
+                            file_name(resource))]
+                        lines.extend("{}\t{}\t{}\t{:.1f}\n".format(*window) for window in windows)
+                    except (IOError, ValueError, struct.error, zlib.error) as e:
+                        print("Couldn't derive coverage for {}: {}".format(resource.name, e))
+                        continue
+                    makedirs(os.path.dirname(path))
+                    atomic_write(path, "".join(lines))
+                    print("Derived coverage for {} from its index, in {}".format(resource.name, path))
+                url = quote("{}/{}/{}/{}".format(self.url_root.rstrip("/"), COVERAGE_FOLDER, resource.file_id, name),
+                            safe=URL_SAFE)
+                # it isn't a DNAnexus file, so it has no file-id
+                folder.resources.insert(folder.resources.index(resource) + 1,
+                                        Resource(None, name, resource.folder, url))
+
+    def expireMirrors(self, min_age=ONE_HOUR):
+        """
+        Remove mirrored files (see `mirror`), and derived coverage (see `addBaiCoverage`), that no manifest in the
+        registry's folder uses any more, ie whose file has changed on DNAnexus, or whose project has left the registry.
+        Recent copies are kept, as another process may be about to write the manifest that uses them.
+        :param min_age: seconds for which a new copy is kept
+        """
+        used = self.state.getFolderFileIds(os.path.dirname(os.path.relpath(self.mirror_folder, self.state.root)))
+        for folder in (self.mirror_folder, self.coverage_folder):
+            if not os.path.isdir(folder):
+                continue
+            for file_id in os.listdir(folder):
+                path = os.path.join(folder, file_id)
+                if file_id not in used and os.path.getmtime(path) < time.time() - min_age:
+                    print("Removing {}, which is no longer used".format(path))
+                    shutil.rmtree(path)
+
+    def prewarmDataset(self, dx_project):
+        """
+        Fetch the files that IGV reads first for a DxDataset (see `DxDataset.getPrewarmFiles`) into the proxy's
+        BlockCache, on background threads, so that the manifests aren't held up. See `finishPrewarming`.
+        """
+        if self.prewarming is None:
+            from multiprocessing.pool import ThreadPool
+            self.prewarming = ThreadPool(max(self.jobs, 4))
+
+        def prewarm(file_id, url, tdf):
+            try:
+                return self.cache.prewarm(file_id, url, tdf)
+            except (IOError, ValueError, struct.error) as e:
+                print("Couldn't prewarm {} ({}): {}".format(file_id, dx_project.name, e))
+                return 0
+
+        for file_id, url, tdf in dx_project.getPrewarmFiles():
+            self.prewarming.apply_async(prewarm, (file_id, url, tdf))
+
+    def finishPrewarming(self):
+        """Wait for any files that are being prewarmed, see `prewarmDataset`."""
+        if self.prewarming is None:
+            return
+        self.prewarming.close()
+        self.prewarming.join()
+        self.prewarming = None
 
     def addDxDataset(self, project, xml_path):
-        xml_relative_path = xml_path.replace(self.folder, '')
-        #print("registry root path: {}\nxml_path: {}\nxml_relative_path: {}\nurl_root: {}".format(self.folder, xml_path, xml_relative_path, self.url_root))
-        url = self.url_root + xml_relative_path
-        url = quote(url, safe="%/:=&?~#+!$,;'@()*[]")
+        """
+        Add an XML manifest to the registry. The URL is held in memory until the next `flushRegistry`.
+        """
+        url = self.getManifestUrl(xml_path)
         print("Adding {} to registry at {}".format(url, self.path))
+        self.pending.add(url)
+        self.removed.discard(url)
+        self.addProjectToCache(project, xml_path)
 
-        if os.path.exists(self.path):
-            with open(self.path, "r") as myregistry:
-                urls = set(myregistry.read().splitlines()) - set([''])
-        else:
-            urls = set()
+    def flushRegistry(self):
+        """
+        Merge any pending URLs into the registry TXT file, and drop any removed URLs. The new file is written alongside
+        the old one, and then renamed over it, so that the web server never serves a partially written registry. The
+        read-merge-write is done under the registry's lock, so concurrent processes don't lose each other's entries.
+        """
+        if not self.pending and not self.removed:
+            return
+        if self.store:
+            # a shared registry's TXT is built on request from the local state, by serve_igvdata
+            self.pending = set()
+            self.removed = set()
+            return
+        with file_lock(self.lock_path):
+            if os.path.exists(self.path):
+                with open(self.path, "r") as myregistry:
+                    urls = set(myregistry.read().splitlines()) - set([''])
+            else:
+                urls = set()
 
-        urls.add(url)
-        urls = list(urls)
-        urls.sort()
+            urls.update(self.pending)
+            urls.difference_update(self.removed)
+            urls = list(urls)
+            urls.sort()
+            atomic_write(self.path, "".join(url + '\n' for url in urls))
+        print("Wrote {} new URLs to registry at {}".format(len(self.pending), self.path))
+        self.pending = set()
+        self.removed = set()
 
-        with open(self.path, "w") as myregistry:
-            for url in urls:
-                myregistry.write(url + '\n')
-        self.addProjectToCache(project)
+    def rewriteRegistryTXT(self):
+        """
+        Rewrite the registry TXT from the manifests known to the local state, and any legacy manifests. This doesn't
+        need DNAnexus, eg after changing `url_root`.
+        """
+        if self.store:
+            print("{} is shared, so its registry TXT is built on request by --serve".format(self.name))
+            return
+        paths = list(self.projects.values()) + [name + ".xml" for name in self.legacy]
+        urls = sorted(self.getManifestUrl(os.path.join(self.folder, path)) for path in paths)
+        with file_lock(self.lock_path):
+            atomic_write(self.path, "".join(url + '\n' for url in urls))
+        print("Wrote {} URLs to registry at {}".format(len(urls), self.path))
 
-    def addProjectToCache(self, project):
-        """The cache represents an in-memory set of projects within the Registry."""
-        self.projects.append(project)
+    def addProjectToCache(self, project, xml_path):
+        """The cache represents an in-memory mapping of the project-id's within the Registry, to their manifest."""
+        self.projects[project.get_id()] = os.path.basename(xml_path)
+        self.legacy.discard(os.path.basename(xml_path)[:-len(".xml")])
 
     def findNewProjects(self):
         """
-        Find projects available on DNAnexus, not present in the local cache
-        :return: string array of project names.
+        Find projects available on DNAnexus, not present in the local cache. Projects are matched by project-id, so
+        renamed projects are not new. Legacy manifests, which pre-date the local state, are matched by name.
+        :return: string array of project-id's.
         """
-        dx_projects = list(dxpy.find_projects(return_handler=True))
-        dx_project_names = [project.name for project in dx_projects]
-        new_dx_projects = list(set(dx_project_names) - set(self.getProjects()))
-        new_dx_projects = [x for x in new_dx_projects if not x.startswith('PIPELINE') and not x.endswith('resources')]
+        dx_projects = list(dxpy.find_projects(describe={"fields": {"name": True}}))
+        new_dx_projects = [project["id"] for project in dx_projects
+                           if project["id"] not in self.projects and project["describe"]["name"] not in self.legacy and
+                           not project["describe"]["name"].startswith('PIPELINE') and
+                           not project["describe"]["name"].endswith('resources')]
         print("Found {} new projects on DNAnexus, for {}".format(len(new_dx_projects), dxpy.whoami()))
         return new_dx_projects
 
-    def forceUpdate(self, existing_only=False):
-        projects = self.projects
-        os.chdir(self.folder)
-        for file in glob.glob("*.xml"):
-            os.unlink(file)
-        self.eraseRegistryTXT()
-        if not existing_only:
-            projects = self.findNewProjects()
-        self.addProjects(projects)
+    def findChangedProjects(self, projects=None):
+        """
+        Find projects within the registry that have been modified on DNAnexus since their manifest was last built, or
+        that were built with different settings (see `fingerprint`), or whose URLs are about to expire (see
+        `refresh_within`). Legacy manifests, which pre-date the local state, are always included. This takes one
+        `find_projects` call, regardless of the number of projects.
+        :param projects: the results of a `find_projects` call, with name and modified described, if already known
+        :return: dict of project-id to the project's description
+        """
+        builds = self.state.getBuilds(self.name)
+        changed = {}
+        if projects is None:
+            projects = dxpy.find_projects(describe={"fields": {"name": True, "modified": True}})
+        for project in projects:
+            project_id, describe = project["id"], project["describe"]
+            if project_id in self.projects or describe["name"] in self.legacy:
+                if self.needsBuild(project_id, describe, builds):
+                    changed[project_id] = describe
+        print("Found {} of {} projects changed on DNAnexus, for {}".format(
+            len(changed), len(self.projects) + len(self.legacy), dxpy.whoami()))
+        return changed
 
-    def eraseRegistryTXT(self):
-        if os.path.exists(self.path):
-            os.unlink(self.path)
+    def reindex(self, project_id, folders=None):
+        """
+        Rebuild a project's manifests, re-crawling only some of its folders if possible.
+        :param project_id: a DX project-id
+        :param folders: list of folders to re-crawl, or None to re-crawl the whole project. The whole project is also
+        re-crawled if the local state doesn't have its previous crawl.
+        """
+        dx_project = self.state.getDataset(self.name, project_id) if folders else None
+        if dx_project is None:
+            self.addProjects([project_id])
+            return
+        for folder in folders:
+            dx_project.reindexFolder(folder)
+        self.addCrawledDataset(dx_project)
+        self.flushRegistry()
+        self.finishPrewarming()
 
-    def testUpdate(self):
-        """Run a subset of projects"""
-        # project_ids = (u'project-BzPb25j0627bFJv6q9g81ZX5', u'project-Bz6GbkQ0VGPv0fpqZZ6ZZGfx', u'project-Bb9KVk8029vp1qzXz4yx4xB3')
-        # project_ids = (u'project-BzPb25j0627bFJv6q9g81ZX5', u'project-Bb9KVk8029vp1qzXz4yx4xB3')
-        project_ids = (u'project-BzQ9qx80Y6qG6FF56Jq27145', u'project-BzPb25j0627bFJv6q9g81ZX5')  # NA12878 public
-        self.addProjects(project_ids)
+    def needsBuild(self, project_id, describe, builds):
+        """
+        :param project_id: a DX project-id
+        :param describe: the project's description, with its name and modified time
+        :param builds: the registry's builds, from `RegistryState.getBuilds`
+        :return: True if the project has no manifest in the registry, has been modified since its manifest was built,
+        was built with different settings, or has URLs that expire within `refresh_within` seconds.
+        """
+        if project_id not in self.projects:
+            return True
+        return self.isStale(builds.get(project_id, (None, None, None)), describe)
 
-# TESTING
-#
-# from dx_igv_registry import *
-# reg = IgvRegistry()
-# reg.getProjects()
-# # reg.findNewProjects()  # >180 projects, so this takes some time.
-# reg.testUpdate()
+    def isStale(self, build, describe):
+        """
+        :param build: the (modified, fingerprint, expires) of a project's last build
+        :param describe: the project's description, with its name and modified time
+        :return: True if the project has been modified since it was built, was built with different settings, or has
+        URLs that expire within `refresh_within` seconds.
+        """
+        modified, fingerprint, expires = build
+        if self.refresh_within is not None and expires is not None:
+            # for short lived URLs, refresh once they are half way to expiry, rather than on every update
+            if expires < time.time() + min(self.refresh_within, self.url_duration // 2):
+                return True
+        return modified is None or describe["modified"] > modified or fingerprint != self.fingerprint
 
-# from dx_igv_registry import *
+    def removeProject(self, project_id):
+        """Remove a project's manifests from the registry. The registry TXT is updated at the next `flushRegistry`."""
+        filename = self.projects.pop(project_id)
+        self.state.forgetManifest(self.name, project_id)
+        self.removeManifests(filename[:-len(".xml")])
+
+    def syncTag(self, tag, projects=None):
+        """
+        Make the registry match the DNAnexus projects with a tag (eg LKCGP), using one `find_projects` call that
+        filters by tag on the server and describes each project. New projects are added, modified projects are
+        rebuilt, and projects that have lost the tag are removed. Legacy manifests, which pre-date the local state, are
+        rebuilt if their name matches a tagged project, but are never removed.
+        :param tag: a DNAnexus project tag
+        :param projects: the results of a `find_projects` call, with name, modified and tags described, if already
+        known. Only those with `tag` are used.
+        """
+        self.state.setRegistryTag(self.name, tag)
+        builds = self.state.getBuilds(self.name)
+        if projects is None:
+            projects = dxpy.find_projects(tags=[tag], describe={"fields": {"name": True, "modified": True, "tags": True}})
+        tagged = dict((project["id"], project["describe"]) for project in projects
+                      if tag in project["describe"]["tags"])
+        build = dict((project_id, describe) for project_id, describe in tagged.items()
+                     if self.needsBuild(project_id, describe, builds))
+        retire = [project_id for project_id in self.projects if project_id not in tagged]
+        print("Found {} projects tagged {}: {} to build, and {} to remove from the registry".format(
+            len(tagged), tag, len(build), len(retire)))
+        for project_id in retire:
+            self.removeProject(project_id)
+        self.addProjects(sorted(build), describes=build)
+
+    def update(self, projects=None):
+        """
+        Rebuild only the projects that have changed since they were last built. See `findChangedProjects`.
+        """
+        changed = self.findChangedProjects(projects)
+        self.addProjects(sorted(changed), describes=changed)
+
+    def refresh(self, projects):
+        """
+        Bring the registry up to date, given a listing of every project on DNAnexus: sync it with its tag, if it was
+        last built with `syncTag`, or otherwise `update` it.
+        :param projects: the results of a `find_projects` call, with name, modified and tags described
+        """
+        tag = self.state.getRegistryTag(self.name)
+        if tag:
+            self.syncTag(tag, projects)
+        else:
+            self.update(projects)
+
+    def forceUpdate(self, existing_only=False):
+        """
+        Rebuild every manifest in the registry, without taking the registry offline. The new manifests and registry TXT
+        are built in a staging folder, and then swapped into place (see `promote`).
+        :param existing_only: if True, only rebuild the projects already in the registry; otherwise rebuild every
+        project available on DNAnexus, or every project with the registry's tag, if it is synced with one (see
+        `syncTag`).
+        """
+        tag = self.state.getRegistryTag(self.name)
+        if existing_only:
+            projects = self.getProjects()
+        elif tag:
+            projects = sorted(project["id"] for project in dxpy.find_projects(tags=[tag]))
+            print("Found {} projects tagged {}".format(len(projects), tag))
+        else:
+            projects = None
+        if self.store:
+            # other registries' manifests share the folder, so rebuild in place; each manifest is replaced atomically
+            self.addProjects(projects if projects is not None else self.findNewProjects() + self.getProjects())
+            return
+        staged = self.staging()
+        staged.addProjects(projects if projects is not None else staged.findNewProjects())
+        self.promote(staged.folder)
+
+    def getGenerationFolder(self, kind):
+        """
+        :param kind: "staging" or "previous"
+        :return: a folder for a whole generation of this registry, within igvdata/.state (on the same file system, so
+        files can be renamed into place, and denied to the web by its .htaccess, as manifests hold pre-authenticated
+        URLs), eg igvdata/.state/LKCGP.staging
+        """
+        relative = os.path.relpath(self.folder, self.root_folder)
+        return os.path.join(self.root_folder, ".state", "{}.{}".format(
+            "" if relative == "." else quote(relative, safe=""), kind))
+
+    def getStagingFolder(self):
+        """:return: the folder that a new generation of this registry is built within"""
+        return self.getGenerationFolder("staging")
+
+    def getPreviousFolder(self):
+        """:return: the folder that holds the previous generation of this registry, for `rollback`"""
+        return self.getGenerationFolder("previous")
+
+    def staging(self):
+        """
+        Create an empty staging folder, and a copy of this registry that writes its manifests and TXT into it. The URLs
+        it generates are those of the live registry, so the staged files can be promoted as they are.
+        :return: IgvRegistry
+        """
+        staging_folder = self.getStagingFolder()
+        if os.path.exists(staging_folder):
+            print("Removing incomplete staging folder " + staging_folder)
+            shutil.rmtree(staging_folder)
+        make_private_folder(os.path.dirname(staging_folder))
+        os.mkdir(staging_folder)
+
+        staged = copy.copy(self)
+        staged.folder = staging_folder
+        staged.path = os.path.join(staging_folder, self.txt)
+        staged.lock_path = os.path.join(staging_folder, "." + self.txt + ".lock")
+        staged.pending = set()
+        staged.removed = set()
+        staged.projects = {}
+        staged.legacy = set()
+        touch(staged.path)
+        return staged
+
+    def listGeneration(self, folder):
+        """
+        :return: the manifests and registry TXT file within a registry folder, ie everything that gets replaced when a
+        new generation is promoted. Hidden files (eg .htaccess), the registry alias symlinks, the TXT files of other
+        ref_genomes, and sub-folders other than session folders (eg the group folders within an igvdata root) are not
+        included.
+        """
+        names = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name.startswith(".") or os.path.islink(path):
+                continue
+            if name.endswith("_dataServerRegistry.txt") and name != self.txt:
+                continue
+            if os.path.isdir(path) and not name.endswith(".sessions"):
+                continue
+            names.append(name)
+        return sorted(names)
+
+    def promote(self, source_folder):
+        """
+        Make the manifests and registry TXT within `source_folder` live, and keep the current generation in
+        `getPreviousFolder()` for `rollback`. Each file is renamed into place, which is atomic, and the registry TXT is
+        renamed last. Stale manifests are removed only after the new TXT stops pointing to them. So every URL in the
+        live registry always points to a complete manifest.
+        :param source_folder: a folder containing a complete generation, which is emptied
+        """
+        previous_folder = self.getPreviousFolder()
+        with file_lock(self.lock_path):
+            live = self.listGeneration(self.folder)
+            incoming = self.listGeneration(source_folder)
+            assert self.txt in incoming, "{} has no registry TXT to promote".format(source_folder)
+
+            # keep the live generation, using hard links where possible, as the live files are about to be replaced
+            if os.path.exists(previous_folder):
+                shutil.rmtree(previous_folder)
+            os.mkdir(previous_folder)
+            for name in live:
+                src, dst = os.path.join(self.folder, name), os.path.join(previous_folder, name)
+                if os.path.isdir(src):
+                    shutil.copytree(src, dst)
+                else:
+                    try:
+                        os.link(src, dst)
+                    except OSError:
+                        shutil.copy2(src, dst)
+
+            for name in incoming:
+                if name == self.txt:
+                    continue
+                src, dst = os.path.join(source_folder, name), os.path.join(self.folder, name)
+                if os.path.isdir(src):
+                    replace_folder(src, dst)
+                else:
+                    os.rename(src, dst)
+            os.rename(os.path.join(source_folder, self.txt), self.path)
+
+            for name in set(live) - set(incoming):
+                path = os.path.join(self.folder, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+        if source_folder == self.getStagingFolder():
+            shutil.rmtree(source_folder)
+        print("Promoted {} new manifests to {}. The previous generation is in {}".format(
+            len(incoming) - 1, self.folder, previous_folder))
+        self.updateCache()
+
+    def rollback(self):
+        """
+        Restore the previous generation of the registry, as kept by `promote`. Rolling back twice restores the
+        generation that was rolled back. The local state only records the latest build of each project, so the
+        restored manifests are recorded as unbuilt (see `RegistryState.forgetBuilds`), and the next update rebuilds
+        them.
+        """
+        if self.store:
+            raise RuntimeError("{} is shared, so it has no previous generation to roll back to".format(self.name))
+        previous_folder = self.getPreviousFolder()
+        if not os.path.exists(previous_folder):
+            raise RuntimeError("There is no previous generation of {} to roll back to".format(self.folder))
+        staging_folder = self.getStagingFolder()
+        if os.path.exists(staging_folder):
+            shutil.rmtree(staging_folder)
+        shutil.copytree(previous_folder, staging_folder)
+        self.promote(staging_folder)
+        self.state.forgetBuilds(self.name)
+
+    def eraseRegistryTXT(self):
+        with file_lock(self.lock_path):
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def report(self):
+        """
+        Summarise the projects within this registry, from the local state only (ie without querying DNAnexus).
+        :return: list of lines
+        """
+        lines = []
+        for project_id, name, path, digest, written in self.state.getManifests(self.name):
+            expires = self.state.getProjectExpiry(project_id)
+            lines.append("{}\t{}\t{} files\twritten {}\tURLs expire {}".format(
+                project_id, name, self.state.countFiles(project_id), time.strftime("%Y-%m-%d", time.localtime(written)),
+                time.strftime("%Y-%m-%d", time.localtime(expires)) if expires else "-"))
+        return lines
+
+    def testUpdate(self):
+        """Run a subset of projects"""
+        # project_ids = (u'project-BzPb25j0627bFJv6q9g81ZX5', u'project-Bz6GbkQ0VGPv0fpqZZ6ZZGfx', u'project-Bb9KVk8029vp1qzXz4yx4xB3')
+        # project_ids = (u'project-BzPb25j0627bFJv6q9g81ZX5', u'project-Bb9KVk8029vp1qzXz4yx4xB3')
+        project_ids = (u'project-BzQ9qx80Y6qG6FF56Jq27145', u'project-BzPb25j0627bFJv6q9g81ZX5')  # NA12878 public
+        self.addProjects(project_ids)
+
+# TESTING
+#
+# from dx_igv_registry import *
+# reg = IgvRegistry()
+# reg.getProjects()
+# # reg.findNewProjects()  # >180 projects, so this takes some time.
+# reg.testUpdate()
+
+# from dx_igv_registry import *
 # reg = IgvRegistry("1kg_v37", '/Users/marcow/var/www/html/igvdata/', 'https://seave.bio/igvdata/', ONE_DAY)
 # reg.getProjects()
 # reg.testUpdate()
 # with open('/Users/marcow/var/www/html/igvdata/1kg_v37_dataServerRegistry.txt', "r") as myregistry:
 #    myregistry.readlines()
 
+class WorkQueue(object):
+    """
+    A queue of project crawls, in an SQLite database on storage shared between hosts (which must support POSIX file
+    locks, eg NFS with locking enabled). A coordinator puts jobs on the queue, via `map`. Workers on any host lease
+    jobs, crawl them, and store the DxDataset as JSON (see `run_worker`, and `dataset_to_json`). The coordinator then
+    writes the manifests and registry TXT. Coordinators that queue the same crawl share its job, which is deleted once
+    every one of them has read it. A job whose worker stops renewing its lease (eg because the host died) is leased
+    again by another worker.
+
+    Results are JSON rather than pickles, as anyone who can write to the shared storage could otherwise run code as
+    the coordinator.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id TEXT NOT NULL,
+            ref_genome TEXT NOT NULL,
+            url_duration INTEGER NOT NULL,
+            describe TEXT,
+            status TEXT NOT NULL,
+            worker TEXT,
+            lease_expires INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            waiters INTEGER NOT NULL DEFAULT 1,
+            result BLOB,
+            error TEXT,
+            created INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+        CREATE INDEX IF NOT EXISTS jobs_project ON jobs (project_id, ref_genome, url_duration, status);
+    """
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, path, lease=ONE_HOUR):
+        """
+        :param path: path to the queue's database
+        :param lease: seconds that a worker may hold a job without renewing its lease
+        """
+        self.path = path
+        self.lease = lease
+        # autocommit mode, so that `lease` can take the database lock with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(path, timeout=300, isolation_level=None)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def put(self, project_id, ref_genome, url_duration, describe=None):
+        """
+        Queue a crawl, unless the same crawl is already queued, or being crawled (eg by another coordinator), in which
+        case the job is shared. Each `put` must be matched by a `release`.
+        :return: the job id
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT id FROM jobs WHERE project_id = ? AND ref_genome = ? AND url_duration = ? "
+                                  "AND status IN ('pending', 'leased')",
+                                  (project_id, ref_genome, url_duration)).fetchone()
+            if row:
+                job_id = row[0]
+                self.db.execute("UPDATE jobs SET waiters = waiters + 1 WHERE id = ?", (job_id,))
+            else:
+                job_id = self.db.execute(
+                    "INSERT INTO jobs (project_id, ref_genome, url_duration, describe, status, created) "
+                    "VALUES (?, ?, ?, ?, 'pending', ?)",
+                    (project_id, ref_genome, url_duration, json.dumps(describe) if describe else None,
+                     int(time.time()))).lastrowid
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def take(self, worker):
+        """
+        Lease the oldest pending job, or a job whose lease has expired. An expired lease counts as a failed attempt, so
+        a job whose workers keep dying is failed after MAX_ATTEMPTS.
+        :param worker: a name for the worker, eg host:pid
+        :return: (job id, project_id, ref_genome, url_duration, describe), or None if there are no jobs
+        """
+        now = int(time.time())
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute("UPDATE jobs SET status = 'failed', error = 'The lease expired ' || attempts || ' times', "
+                            "lease_expires = NULL WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                            (now, self.MAX_ATTEMPTS))
+            row = self.db.execute("SELECT id, project_id, ref_genome, url_duration, describe FROM jobs "
+                                  "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                                  "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row:
+                self.db.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, "
+                                "attempts = attempts + 1 WHERE id = ?", (worker, now + self.lease, row[0]))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3], json.loads(row[4]) if row[4] else None
+
+    def renew(self, job_id, worker):
+        """Extend a worker's lease on a job. :return: False if the job has since been leased to another worker"""
+        cursor = self.db.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                 (int(time.time()) + self.lease, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, dataset):
+        """Store a crawled DxDataset as the result of a job."""
+        self.db.execute("UPDATE jobs SET status = 'done', result = ?, lease_expires = NULL WHERE id = ? AND worker = ?",
+                        (dataset_to_json(dataset), job_id, worker))
+
+    def fail(self, job_id, worker, error):
+        """Record a failed crawl. The job is retried, up to MAX_ATTEMPTS times."""
+        self.db.execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, error = ?, "
+                        "lease_expires = NULL WHERE id = ? AND worker = ?", (self.MAX_ATTEMPTS, error, job_id, worker))
+
+    def release(self, job_id):
+        """Stop waiting for a job, see `put`. The job is deleted once no coordinator is waiting for it."""
+        self.db.execute("UPDATE jobs SET waiters = waiters - 1 WHERE id = ?", (job_id,))
+        self.db.execute("DELETE FROM jobs WHERE id = ? AND waiters <= 0", (job_id,))
+
+    def map(self, project_ids, ref_genome, url_duration, describes=None, stop=None, interval=5):
+        """
+        Queue a crawl of each project, then wait for the workers.
+        :param project_ids: list of project-id's
+        :param describes: optional dict of project-id to the project's description
+        :param stop: optional threading.Event, which stops the wait early
+        :param interval: seconds between checks for finished jobs
+        :return: generator of crawled DxDatasets, in the order in which they finish. Jobs that fail MAX_ATTEMPTS times
+        are reported, and skipped. Each job is released once it has been handled, or when the wait stops early, so the
+        queue doesn't grow.
+        """
+        describes = describes or {}
+        # job id -> project-id
+        waiting = dict((self.put(project_id, ref_genome, url_duration, describes.get(project_id)), project_id)
+                       for project_id in project_ids)
+        print("Queued {} projects in {}".format(len(waiting), self.path))
+        try:
+            while waiting and not (stop and stop.is_set()):
+                ids = ",".join(str(job_id) for job_id in waiting)
+                rows = self.db.execute("SELECT id, status, result, error FROM jobs WHERE status IN ('done', 'failed') "
+                                       "AND id IN ({})".format(ids)).fetchall()
+                # jobs are only deleted once released by every coordinator, so this is only after manual changes
+                gone = set(waiting) - set(row[0] for row in self.db.execute(
+                    "SELECT id FROM jobs WHERE id IN ({})".format(ids)))
+                for job_id in gone:
+                    print("Job {} for {} is no longer queued, so it's skipped".format(job_id, waiting.pop(job_id)))
+                for job_id, status, result, error in rows:
+                    del waiting[job_id]
+                    self.release(job_id)
+                    if status == "done":
+                        yield dataset_from_json(result)
+                    else:
+                        print("Job {} failed: {}".format(job_id, error))
+                if waiting and not rows:
+                    time.sleep(interval)
+        finally:
+            for job_id in waiting:
+                self.release(job_id)
+
+
+def dataset_to_json(dataset):
+    """
+    :param dataset: a crawled DxDataset
+    :return: the DxDataset as JSON, which, unlike a pickle, can't run code when it's loaded. See `dataset_from_json`.
+    """
+    def folderData(folder):
+        return [folder.name, folder.path, [folderData(subfolder) for subfolder in folder.folders],
+                [list(resource) for resource in folder.resources]]
+
+    state = dataset.__getstate__()
+    state["root"] = folderData(dataset.root)
+    return json.dumps(state)
+
+
+def dataset_from_json(data):
+    """
+    :param data: JSON from `dataset_to_json`
+    :return: DxDataset
+    :raise ValueError: if it isn't a DxDataset's JSON
+    """
+    def buildFolder(data):
+        name, path, subfolders, resources = data
+        folder = Folder(name, path)
+        folder.folders = [buildFolder(subfolder) for subfolder in subfolders]
+        folder.resources = [Resource(*resource) for resource in resources]
+        return folder
+
+    try:
+        state = json.loads(data)
+        state["root"] = buildFolder(state["root"])
+    except (TypeError, KeyError) as e:
+        raise ValueError("Not a DxDataset: {!r}".format(e))
+    dataset = DxDataset.__new__(DxDataset)
+    dataset.__setstate__(state)
+    return dataset
+
+
+def stop_on_signals():
+    """
+    :return: a threading.Event, which is set when this process receives SIGTERM or SIGINT (Ctrl-C). Long running modes
+    check it between projects, so that they can stop cleanly.
+    """
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        print("Received signal {}, stopping after the current project".format(signum))
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    return stop
+
+
+def open_registries(igvdata_path, stop=None, **kwargs):
+    """
+    Open every IgvRegistry within an igvdata root, with the settings recorded in its local state.
+    :param stop: optional threading.Event, used to stop each registry's `addProjects`
+    :param kwargs: any other arguments to IgvRegistry, eg jobs
+    :return: list of IgvRegistry
+    """
+    state = RegistryState(igvdata_path)
+    registries = []
+    for settings in state.getRegistries():
+        reg = recorded_registry(igvdata_path, settings, **kwargs)
+        if stop is not None:
+            reg.stop = stop
+        registries.append(reg)
+    state.close()
+    return registries
+
+
+def open_registry(igvdata_path, group, ref_genome, **kwargs):
+    """
+    Open an IgvRegistry with the settings recorded in the local state, without recording them again, eg for read-only
+    commands such as --report, which shouldn't need the flags that the registry was built with.
+    :return: IgvRegistry, or None if the registry isn't in the local state
+    """
+    state = RegistryState(igvdata_path)
+    settings = state.getRegistry("{}/{}".format(group or "", ref_genome))
+    state.close()
+    if settings is None:
+        return None
+    return recorded_registry(igvdata_path, settings, record=False, **kwargs)
+
+
+def recorded_registry(igvdata_path, settings, **kwargs):
+    """:param settings: a registry's recorded settings, see `RegistryState.getRegistries`"""
+    group, ref_genome, url_root, url_duration, formats, store, proxy, prewarm, mirror_under, bai_coverage = settings
+    return IgvRegistry(ref_genome=ref_genome, folder=igvdata_path, url_root=url_root, url_duration=url_duration,
+                       group=group, formats=formats.split(","), shared=store is not None, proxy=proxy,
+                       prewarm=bool(prewarm), mirror_under=mirror_under, bai_coverage=bool(bai_coverage), **kwargs)
+
+
+def run_worker(queue_path, lease=ONE_HOUR, interval=10):
+    """
+    Crawl projects from a WorkQueue, until stopped with SIGTERM or Ctrl-C. While a project is being crawled, its lease
+    is renewed every `lease / 3` seconds, from a separate thread.
+    :param queue_path: path to the queue's database, on shared storage
+    :param lease: seconds that a job may be held without renewing its lease
+    :param interval: seconds to wait when the queue is empty
+    """
+    stop = stop_on_signals()
+
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    queue = WorkQueue(queue_path, lease)
+    print("Worker {} waiting for jobs in {}".format(worker, queue_path))
+    while not stop.is_set():
+        job = queue.take(worker)
+        if job is None:
+            stop.wait(interval)
+            continue
+        job_id, project_id, ref_genome, url_duration, describe = job
+        crawled = threading.Event()
+
+        def renew():
+            # sqlite connections can't be shared between threads
+            heartbeat = WorkQueue(queue_path, lease)
+            while not crawled.wait(lease / 3.0):
+                heartbeat.renew(job_id, worker)
+            heartbeat.close()
+
+        renewer = threading.Thread(target=renew)
+        renewer.daemon = True
+        renewer.start()
+        try:
+            dx_project = DxDataset(project=project_id, ref_genome=ref_genome, url_duration=url_duration,
+                                   describe=describe)
+            dx_project.addData()
+            crawled.set()
+            queue.complete(job_id, worker, dx_project)
+            print("Worker {} finished job {}: {}".format(worker, job_id, dx_project.name))
+        except Exception as e:
+            crawled.set()
+            queue.fail(job_id, worker, "{}: {}".format(type(e).__name__, e))
+            print("Worker {} failed job {}: {}".format(worker, job_id, e))
+        renewer.join()
+    queue.close()
+    print("Worker {} stopped".format(worker))
+
+
+def serve_updates(igvdata_path, interval=ONE_HOUR, refresh_within=ONE_WEEK, jobs=1):
+    """
+    Keep every registry within an igvdata root up to date, until stopped with SIGTERM or Ctrl-C. Each poll makes one
+    `find_projects` call for all registries, then rebuilds only the projects that are new, modified, have lost or
+    gained a registry's tag, or whose URLs expire within `refresh_within` seconds. The dxpy session, and each
+    registry's cache, are kept between polls. Polls are jittered by +/-10%, and back off exponentially after errors.
+    :param igvdata_path: the igvdata root. Its registries are those recorded in its local state.
+    :param interval: seconds between polls
+    :param refresh_within: rebuild projects whose URLs expire within this many seconds
+    :param jobs: the number of projects to crawl at once
+    """
+    stop = stop_on_signals()
+
+    registries = open_registries(igvdata_path, stop, jobs=jobs, refresh_within=refresh_within)
+    print("Serving updates for {} registries, every {}s".format(len(registries), interval))
+
+    failures = 0
+    while not stop.is_set():
+        try:
+            projects = list(dxpy.find_projects(describe={"fields": {"name": True, "modified": True, "tags": True}}))
+            for reg in registries:
+                if stop.is_set():
+                    break
+                reg.updateCache()
+                reg.refresh(projects)
+            failures = 0
+            delay = interval
+        except Exception as e:
+            failures += 1
+            delay = min(interval, 60 * 2 ** min(failures, 10))
+            print("Update failed ({} in a row), retrying in {}s: {}".format(failures, delay, e))
+        stop.wait(delay * random.uniform(0.9, 1.1))
+
+    for reg in registries:
+        reg.flushRegistry()
+        reg.state.close()
+    print("Stopped serving updates")
+
+
+class ReindexRequests(object):
+    """
+    Pending reindex requests, from `serve_webhook`. Repeated requests for a project are merged, and a project is only
+    due once no request for it has arrived for `debounce` seconds, so a pipeline that finishes in several steps causes
+    one rebuild. A request for a whole project replaces requests for its folders, as does a request for a parent folder.
+    """
+
+    def __init__(self, debounce=30):
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        # project-id -> [time due, set of folders, or None for the whole project]
+        self.pending = {}
+
+    def add(self, project_id, folder=None):
+        """:return: the folders that will be re-crawled for this project, or None for the whole project"""
+        with self.lock:
+            folders = self.pending.get(project_id, (None, set()))[1]
+            if folder is None or folder.strip("/") == "":
+                folders = None
+            elif folders is not None:
+                folder = "/" + folder.strip("/")
+                if not any(folder == f or folder.startswith(f + "/") for f in folders):
+                    folders = set(f for f in folders if not f.startswith(folder + "/"))
+                    folders.add(folder)
+            self.pending[project_id] = [time.time() + self.debounce, folders]
+            return sorted(folders) if folders is not None else None
+
+    def takeDue(self):
+        """:return: list of (project-id, folders) that are due, which are removed from the pending requests"""
+        now = time.time()
+        with self.lock:
+            due = [(project_id, folders) for project_id, (when, folders) in self.pending.items() if when <= now]
+            for project_id, folders in due:
+                del self.pending[project_id]
+        return due
+
+
+def serve_webhook(igvdata_path, port, debounce=30, token=None, jobs=1):
+    """
+    Run an HTTP endpoint that pipelines can call as their last step, to have their project reindexed, until stopped
+    with SIGTERM or Ctrl-C:
+
+        curl -X POST -H 'X-Reindex-Token: ...' 'http://host:port/reindex?project=project-xxxx&folder=/run1/bams'
+
+    The folder is optional. Requests are de-duplicated and debounced (see ReindexRequests), then the project is rebuilt
+    within every registry that already contains it, and every registry synced with a tag that the project has.
+    :param igvdata_path: the igvdata root. Its registries are those recorded in its local state.
+    :param port: port to listen on
+    :param debounce: seconds to wait for further requests for a project, before reindexing it
+    :param token: if set, then requests must include this token, in the X-Reindex-Token header. It isn't accepted as a
+    query parameter, as URLs are written to access logs.
+    :param jobs: the number of projects to crawl at once
+    """
+    stop = stop_on_signals()
+    requests = ReindexRequests(debounce)
+
+    class ReindexHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlparse.urlparse(self.path)
+            params = urlparse.parse_qs(url.query)
+            if url.path != "/reindex":
+                return self.reply(404, {"error": "Not found"})
+            # compared in constant time, so the token can't be guessed from how long a wrong one takes to reject
+            if token and not hmac.compare_digest(token, self.headers.get("X-Reindex-Token") or ""):
+                return self.reply(403, {"error": "Invalid token, which must be sent in the X-Reindex-Token header"})
+            project_id = params.get("project", [""])[0]
+            if not project_id.startswith("project-"):
+                return self.reply(400, {"error": "project must be a project-id"})
+            folders = requests.add(project_id, params.get("folder", [None])[0])
+            self.reply(202, {"project": project_id, "folders": folders, "debounce": debounce})
+
+        def reply(self, status, body):
+            data = json.dumps(body)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = BaseHTTPServer.HTTPServer(("", port), ReindexHandler)
+    listener = threading.Thread(target=server.serve_forever)
+    listener.daemon = True
+    listener.start()
+
+    registries = open_registries(igvdata_path, stop, jobs=jobs)
+    print("Listening for reindex requests on port {}, for {} registries".format(port, len(registries)))
+    while not stop.is_set():
+        for project_id, folders in requests.takeDue():
+            try:
+                tags = None
+                for reg in registries:
+                    reg.updateCache()
+                    tag = reg.state.getRegistryTag(reg.name)
+                    if project_id not in reg.projects and tag:
+                        if tags is None:
+                            tags = dxpy.DXProject(project_id).describe(fields={"tags": True})["tags"]
+                        if tag not in tags:
+                            continue
+                    elif project_id not in reg.projects:
+                        continue
+                    print("Reindexing {} ({}) within {}".format(
+                        project_id, ", ".join(sorted(folders)) if folders else "all folders", reg.name))
+                    reg.reindex(project_id, folders)
+            except Exception as e:
+                print("Failed to reindex {}: {}".format(project_id, e))
+        stop.wait(1)
+
+    server.shutdown()
+    for reg in registries:
+        reg.state.close()
+    print("Stopped listening for reindex requests")
+
+
+class EvictionPolicy(object):
+    """
+    Chooses which blocks a BlockCache evicts, to keep it within a budget of bytes, and each group's data within its
+    quota. Blocks are in one of two tiers:
+    * pinned: blocks of indexes and coverage files (eg BAI, TBI, TDF), which are small, and read whenever anyone opens
+      a sample. They are only evicted once there are no data blocks left, least recently used first.
+    * data: blocks of everything else (eg BAMs), which are large, and mostly read once. They are evicted by S3-FIFO:
+      new blocks enter a small FIFO queue, and only those read again before they reach its head move on to the main
+      FIFO queue, so scrolling through one huge BAM can't flush out the blocks that are read over and over. Blocks
+      evicted from the small queue are remembered (as ghosts), and go straight to the main queue if they're fetched
+      again.
+    Blocks are identified by any hashable key. It isn't thread-safe, so BlockCache serialises its calls.
+    """
+    # the share of the data blocks' bytes for the small queue
+    SMALL_SHARE = 0.1
+    MAX_FREQUENCY = 3
+
+    def __init__(self, budget=None, quotas=None):
+        """
+        :param budget: bytes of blocks to keep, or None for no limit
+        :param quotas: dict of group -> bytes of data blocks to keep for that group
+        """
+        self.budget = budget
+        self.quotas = quotas or {}
+        # key -> [size, frequency, group], oldest first
+        self.small = OrderedDict()
+        self.main = OrderedDict()
+        self.ghosts = OrderedDict()
+        # key -> size, least recently used first
+        self.pinned = OrderedDict()
+        self.small_bytes = self.main_bytes = self.pinned_bytes = 0
+        self.group_bytes = {}
+
+    def __contains__(self, key):
+        return key in self.small or key in self.main or key in self.pinned
+
+    def getTotal(self):
+        return self.small_bytes + self.main_bytes + self.pinned_bytes
+
+    def touch(self, key):
+        """
+        Note a read of a cached block.
+        :return: False if the block isn't known
+        """
+        entry = self.small.get(key) or self.main.get(key)
+        if entry is not None:
+            entry[1] = min(entry[1] + 1, self.MAX_FREQUENCY)
+        elif key in self.pinned:
+            self.pinned[key] = self.pinned.pop(key)
+        else:
+            return False
+        return True
+
+    def admit(self, key, size, pinned=False, group=None):
+        """
+        Add a newly cached block.
+        :param size: bytes of the block
+        :param pinned: whether it's in the pinned tier
+        :param group: the group to charge a data block to, or None
+        :return: list of the keys of the blocks to evict, which may include this one
+        """
+        if self.touch(key):
+            return []
+        if pinned:
+            self.pinned[key] = size
+            self.pinned_bytes += size
+        else:
+            entry = [size, 0, group]
+            if key in self.ghosts:
+                del self.ghosts[key]
+                self.main[key] = entry
+                self.main_bytes += size
+            else:
+                self.small[key] = entry
+                self.small_bytes += size
+            self.group_bytes[group] = self.group_bytes.get(group, 0) + size
+        evicted = []
+        quota = self.quotas.get(group)
+        while not pinned and quota is not None and self.group_bytes[group] > quota:
+            evicted.append(self.evictGroup(group))
+        while self.budget is not None and self.getTotal() > self.budget:
+            evicted.append(self.evictData() if self.small or self.main else self.evictPinned())
+        return evicted
+
+    def evictData(self):
+        """:return: the key of the next data block to evict, which is forgotten"""
+        while True:
+            if self.small and (not self.main or self.small_bytes > self.SMALL_SHARE * (self.small_bytes +
+                                                                                       self.main_bytes)):
+                key, entry = self.small.popitem(last=False)
+                self.small_bytes -= entry[0]
+                if entry[1]:
+                    # it was read again while in the small queue
+                    entry[1] = 0
+                    self.main[key] = entry
+                    self.main_bytes += entry[0]
+                    continue
+                self.ghosts[key] = None
+                while len(self.ghosts) > max(len(self.main) + len(self.small), 1024):
+                    self.ghosts.popitem(last=False)
+            else:
+                key, entry = self.main.popitem(last=False)
+                self.main_bytes -= entry[0]
+                if entry[1]:
+                    entry[1] -= 1
+                    self.main[key] = entry
+                    self.main_bytes += entry[0]
+                    continue
+            self.group_bytes[entry[2]] -= entry[0]
+            return key
+
+    def evictGroup(self, group):
+        """:return: the key of the oldest data block charged to a group, which is forgotten"""
+        for queue in (self.small, self.main):
+            for key, entry in queue.items():
+                if entry[2] == group:
+                    del queue[key]
+                    if queue is self.small:
+                        self.small_bytes -= entry[0]
+                    else:
+                        self.main_bytes -= entry[0]
+                    self.group_bytes[group] -= entry[0]
+                    return key
+
+    def evictPinned(self):
+        """:return: the key of the least recently used pinned block, which is forgotten"""
+        key, size = self.pinned.popitem(last=False)
+        self.pinned_bytes -= size
+        return key
+
+
+class BlockCache(object):
+    """
+    An on-disk cache of the content of DNAnexus files, in fixed size blocks, for the caching proxy of
+    `serve_igvdata`. DNAnexus files can't change once they are closed, so a cached block never goes stale. Blocks
+    that aren't cached are fetched from the file's pre-authenticated URL, with an HTTP Range request.
+
+    Each file has a folder named by its file-id, holding one file per block (named by its block number), and a `size`
+    file holding the size of the whole file. Indexes and coverage files also have a `pinned` file, which puts their
+    blocks in the pinned tier of the EvictionPolicy, if the cache has a budget or quotas.
+    """
+    BLOCK_SIZE = 1 << 20
+    PINNED_EXTENSIONS = (".bai", ".crai", ".csi", ".tbi", ".idx", ".tdf")
+    # seconds between scans for blocks cached by other processes, see `scanPeriodically`
+    SCAN_INTERVAL = 5 * 60
+
+    def __init__(self, folder, block_size=BLOCK_SIZE, readahead=0, budget=None, quotas=None, get_group=None):
+        """
+        :param folder: folder to keep the cache within
+        :param block_size: bytes per block
+        :param readahead: bytes to fetch ahead of sequential reads of BGZF files, see `noteRead`
+        :param budget: bytes of blocks to keep, or None to keep every block
+        :param quotas: dict of group -> bytes of data blocks to keep for files of that group
+        :param get_group: function(file_id) that returns the group that a file is charged to, or None
+        """
+        self.folder = folder
+        self.block_size = block_size
+        self.readahead = readahead
+        self.policy = EvictionPolicy(budget, quotas) if budget is not None or quotas else None
+        self.policy_lock = threading.Lock()
+        self.get_group = get_group or (lambda file_id: None)
+        # file-id -> (pinned, group)
+        self.tiers = {}
+        # (file-id, block) of blocks that were read ahead, and haven't been read since, so their first read isn't
+        # taken as a repeated read by the EvictionPolicy
+        self.unread = set()
+        # file-id -> (start, end) of its latest read, for the most recently read files
+        self.recent = OrderedDict()
+        self.recent_lock = threading.Lock()
+        # read ahead for a few files at once, at most
+        self.readaheads = threading.Semaphore(4)
+        # concurrent requests for the same block (eg from everyone in a meeting opening the same locus) share one fetch
+        self.fetches = SingleFlight()
+        makedirs(folder)
+        if self.policy is not None:
+            self.loadPolicy()
+
+    def getBlockPath(self, file_id, block):
+        return os.path.join(self.folder, file_id, str(block))
+
+    def loadPolicy(self):
+        """
+        Admit the cached blocks that the EvictionPolicy doesn't know yet, oldest first, evicting any over budget. This
+        is run at startup, for blocks cached by earlier runs, and then by `scanPeriodically`, for blocks cached by
+        other processes (eg with --prewarm).
+        :return: the number of blocks admitted
+        """
+        blocks = []
+        for file_id in os.listdir(self.folder):
+            file_path = os.path.join(self.folder, file_id)
+            if not file_id.startswith("file-") or not os.path.isdir(file_path):
+                continue
+            for name in os.listdir(file_path):
+                if not name.isdigit():
+                    continue
+                with self.policy_lock:
+                    if (file_id, int(name)) in self.policy:
+                        continue
+                try:
+                    stat = os.stat(os.path.join(file_path, name))
+                except OSError as e:
+                    # evicted since it was listed
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                blocks.append((stat.st_mtime, file_id, int(name), stat.st_size))
+        for mtime, file_id, block, size in sorted(blocks):
+            self.account(file_id, block, size, known=False)
+        if blocks:
+            print("Cache {} holds {} MB, of which {} MB is pinned".format(
+                self.folder, self.policy.getTotal() >> 20, self.policy.pinned_bytes >> 20))
+        return len(blocks)
+
+    def scanPeriodically(self):
+        """
+        Run `loadPolicy` every SCAN_INTERVAL seconds, on a background thread, so that blocks cached by other processes
+        count toward the budget without waiting for them to be read.
+        """
+        def scan():
+            while True:
+                time.sleep(self.SCAN_INTERVAL)
+                try:
+                    self.loadPolicy()
+                except (IOError, OSError) as e:
+                    print("Couldn't scan {}: {}".format(self.folder, e))
+
+        thread = threading.Thread(target=scan)
+        thread.daemon = True
+        thread.start()
+
+    def getTier(self, file_id, url=None):
+        """
+        :param url: the file's URL, or None. The file name at the end of it marks indexes and coverage files as pinned.
+        :return: (whether the file's blocks are pinned, the group that they're charged to)
+        """
+        tier = self.tiers.get(file_id)
+        if tier is None:
+            pinned_path = os.path.join(self.folder, file_id, "pinned")
+            name = urlparse.urlsplit(url).path.lower() if url else ""
+            pinned = os.path.exists(pinned_path)
+            if not pinned and name.endswith(self.PINNED_EXTENSIONS):
+                makedirs(os.path.dirname(pinned_path))
+                atomic_write(pinned_path, "")
+                pinned = True
+            tier = self.tiers[file_id] = (pinned, None if pinned else self.get_group(file_id))
+        return tier
+
+    def account(self, file_id, block, size, url=None, known=True, ahead=False):
+        """
+        Note a read (or a fetch) of a cached block, and delete whichever blocks the EvictionPolicy then evicts.
+        :param known: False if the block has just been cached
+        :param ahead: whether the block has just been read ahead
+        """
+        if self.policy is None:
+            return
+        key = (file_id, block)
+        with self.policy_lock:
+            if known and key in self.unread:
+                self.unread.discard(key)
+                return
+            if known and self.policy.touch(key):
+                return
+        # a block that isn't known may have been cached by another process, eg with --prewarm
+        pinned, group = self.getTier(file_id, url)
+        with self.policy_lock:
+            evicted = self.policy.admit(key, size, pinned, group)
+            if ahead:
+                self.unread.add(key)
+            self.unread.difference_update(evicted)
+        for evicted_id, evicted_block in evicted:
+            try:
+                os.remove(self.getBlockPath(evicted_id, evicted_block))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def getSize(self, file_id, url):
+        """
+        :param url: the file's pre-authenticated URL, or None if it has expired
+        :return: the size of the file, in bytes. This fetches the first block, if the size isn't known yet.
+        """
+        size_path = os.path.join(self.folder, file_id, "size")
+        if not os.path.exists(size_path):
+            self.getBlock(file_id, url, 0)
+        with open(size_path) as size_file:
+            return int(size_file.read())
+
+    def getBlock(self, file_id, url, block, ahead=False):
+        """
+        :return: the content of a block of a file, from the cache if possible, or otherwise from `url`. If the block is
+        already being fetched for another request, then this waits for that fetch, rather than making another.
+        :param ahead: whether the block is being read ahead, see `noteRead`
+        """
+        data = self.readBlock(file_id, block, touch=not ahead)
+        if data is not None:
+            return data
+        if url is None:
+            raise IOError(errno.ENOENT, "{} block {} isn't cached, and its URL has expired".format(file_id, block))
+        return self.fetches.do((file_id, block), lambda: self.fetchBlock(file_id, url, block, ahead))
+
+    def readBlock(self, file_id, block, touch=True):
+        """
+        :param touch: whether to count this as a read of the block, by the EvictionPolicy
+        :return: the content of a block of a file, or None if it isn't cached
+        """
+        try:
+            with open(self.getBlockPath(file_id, block), "rb") as block_file:
+                data = block_file.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        if touch:
+            self.account(file_id, block, len(data))
+        return data
+
+    def fetchBlock(self, file_id, url, block, ahead=False):
+        """Fetch a block of a file from `url` into the cache. See `getBlock`."""
+        # another request may have just finished fetching it
+        data = self.readBlock(file_id, block, touch=not ahead)
+        if data is not None:
+            return data
+        path = self.getBlockPath(file_id, block)
+        data, size = fetch_range(url, block * self.block_size, (block + 1) * self.block_size - 1)
+        makedirs(os.path.dirname(path))
+        # mark indexes and coverage files as pinned, even in a cache without a policy (eg one that's prewarmed)
+        self.getTier(file_id, url)
+        atomic_write(path, data)
+        atomic_write(os.path.join(self.folder, file_id, "size"), str(size))
+        self.account(file_id, block, len(data), url, known=False, ahead=ahead)
+        return data
+
+    def read(self, file_id, url, start, end):
+        """
+        Read a range of bytes of a file, block by block.
+        :param start: offset of the first byte
+        :param end: offset of the last byte
+        :return: generator of byte strings
+        """
+        for block in range(start // self.block_size, end // self.block_size + 1):
+            data = self.getBlock(file_id, url, block)
+            offset = block * self.block_size
+            yield data[max(start - offset, 0):end - offset + 1]
+
+    def openRead(self, file_id, url, start, end):
+        """
+        Like `read`, but cached blocks are opened rather than read, so that they can be sent without copying them into
+        memory (see `send_file_range`).
+        :return: generator of either (open block file, offset within it, length) for each cached block, or a byte
+        string for each block that had to be fetched. Each block file is closed when the next item is requested.
+        """
+        for block in range(start // self.block_size, end // self.block_size + 1):
+            offset = block * self.block_size
+            first, last = max(start - offset, 0), end - offset
+            try:
+                block_file = open(self.getBlockPath(file_id, block), "rb")
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                yield self.getBlock(file_id, url, block)[first:last + 1]
+                continue
+            # the block may now be evicted, but it stays readable until it's closed
+            with block_file:
+                size = os.fstat(block_file.fileno()).st_size
+                self.account(file_id, block, size)
+                yield block_file, first, min(last + 1, size) - first
+
+    def noteRead(self, file_id, url, start, end, size):
+        """
+        Note a read of a file, and if it follows on from the previous read of the file (eg IGV panning along a BAM),
+        and the file is BGZF compressed (eg BAM, or bgzipped VCF), then fetch the next `readahead` bytes into the cache,
+        on a background thread. See `readAhead`.
+        :param size: the size of the file
+        """
+        if not self.readahead or url is None:
+            return
+        with self.recent_lock:
+            previous = self.recent.pop(file_id, None)
+            self.recent[file_id] = (start, end)
+            if len(self.recent) > 1024:
+                self.recent.popitem(last=False)
+        if previous is None or not previous[0] <= start <= previous[1] + self.block_size:
+            return
+        window_end = min(end + self.readahead, size - 1)
+        if window_end <= end or os.path.exists(self.getBlockPath(file_id, window_end // self.block_size)):
+            # the window has already been read ahead
+            return
+        if not self.readaheads.acquire(False):
+            return
+        thread = threading.Thread(target=self.readAhead, args=(file_id, url, start, end, window_end, size))
+        thread.daemon = True
+        thread.start()
+
+    def readAhead(self, file_id, url, start, end, window_end, size):
+        """
+        Fetch the blocks after a read up to `window_end`, extended to the end of the BGZF block that straddles it, so
+        that the data read ahead can be decompressed whole. IGV reads BGZF files from the start of a BGZF block, so the
+        BGZF blocks are found by following their sizes from `start`.
+        """
+        blocks = {}
+
+        def read(offset, length):
+            data = b""
+            while len(data) < length and offset < size:
+                block = offset // self.block_size
+                if block not in blocks:
+                    blocks.clear()
+                    blocks[block] = self.getBlock(file_id, url, block, ahead=True)
+                chunk = blocks[block][offset - block * self.block_size:][:length - len(data)]
+                if not chunk:
+                    break
+                data += chunk
+                offset += len(chunk)
+            return data
+
+        try:
+            offset = start
+            while offset <= window_end:
+                bgzf_size = bgzf_block_size(read(offset, 18))
+                if bgzf_size is None:
+                    # not BGZF, or not the start of a BGZF block
+                    return
+                offset += bgzf_size
+            for block in range(end // self.block_size + 1, min(offset - 1, size - 1) // self.block_size + 1):
+                self.getBlock(file_id, url, block, ahead=True)
+        except (IOError, struct.error) as e:
+            print("Couldn't read ahead in {}: {}".format(file_id, e))
+        finally:
+            self.readaheads.release()
+
+    def prewarm(self, file_id, url, tdf=False):
+        """
+        Cache a file ahead of its first use: the whole file, or for a TDF, just the parts that IGV reads first (see
+        `tdf_prewarm_ranges`).
+        :return: the number of bytes of the file that are now cached
+        """
+        size = self.getSize(file_id, url)
+        if tdf:
+            ranges = tdf_prewarm_ranges(lambda start, end: b"".join(self.read(file_id, url, start, end)))
+        else:
+            ranges = [(0, size - 1)]
+        blocks = set()
+        for start, end in ranges:
+            end = min(end, size - 1)
+            blocks.update(range(start // self.block_size, end // self.block_size + 1))
+            for data in self.read(file_id, url, start, end):
+                pass
+        return min(len(blocks) * self.block_size, size)
+
+
+class SingleFlight(object):
+    """
+    Run a function once for any number of concurrent callers with the same key. Callers that arrive while it's
+    running wait for it, and share its result (or its exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function):
+        """:return: the result of `function()`, or of the call that was already running for `key`"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                # [finished, result, exception]
+                call = self.calls[key] = [threading.Event(), None, None]
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = function()
+            return call[1]
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+
+
+# each thread keeps one connection to each download host alive, so TLS handshakes aren't repeated for every fetch
+upstream_connections = threading.local()
+
+
+def get_connection(scheme, host):
+    """:return: this thread's kept alive httplib connection to a host, eg "dl.dnanexus.com:443" """
+    connections = upstream_connections.__dict__.setdefault("connections", {})
+    if (scheme, host) not in connections:
+        connection_class = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        connections[(scheme, host)] = connection_class(host, timeout=60)
+    return connections[(scheme, host)]
+
+
+def drop_connection(scheme, host):
+    connection = upstream_connections.__dict__.get("connections", {}).pop((scheme, host), None)
+    if connection is not None:
+        connection.close()
+
+
+def fetch_range(url, start, end, redirects=5):
+    """
+    Fetch a range of bytes from a URL, eg a pre-authenticated DNAnexus URL, over a kept alive connection (see
+    `get_connection`).
+    :param start: offset of the first byte
+    :param end: offset of the last byte, which may be beyond the end of the file
+    :param redirects: the number of redirects to follow
+    :return: (the content of the range, the size of the whole file)
+    """
+    parts = urlparse.urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    for attempt in range(2):
+        connection = get_connection(parts.scheme, parts.netloc)
+        try:
+            connection.request("GET", path, headers={"Range": "bytes={}-{}".format(start, end)})
+            response = connection.getresponse()
+            data = response.read()
+            break
+        except (httplib.HTTPException, socket.error) as e:
+            # the host may have closed a connection that had been idle, so retry once on a new connection
+            drop_connection(parts.scheme, parts.netloc)
+            if attempt:
+                raise IOError("Couldn't fetch from {}: {!r}".format(parts.netloc, e))
+    if response.getheader("Connection", "").lower() == "close":
+        drop_connection(parts.scheme, parts.netloc)
+    if response.status in (301, 302, 303, 307, 308) and redirects:
+        return fetch_range(urlparse.urljoin(url, response.getheader("Location")), start, end, redirects - 1)
+    if response.status not in (200, 206):
+        # the URL is pre-authenticated, so only its host is logged
+        raise IOError("Couldn't fetch from {}: {} {}".format(parts.netloc, response.status, response.reason))
+    content_range = response.getheader("Content-Range")
+    if content_range:
+        # eg "bytes 0-1048575/73100523"
+        return data, int(content_range.rsplit("/", 1)[1])
+    # the server ignored the Range, and sent the whole file
+    return data[start:end + 1], len(data)
+
+
+def fetch_file(url, max_size=None):
+    """
+    Fetch a whole file from a URL, unless it's larger than `max_size` bytes, which is checked with a one byte Range
+    request before the file is fetched.
+    :return: the file's content, or None if it's too large
+    """
+    data, size = fetch_range(url, 0, 0)
+    if max_size is not None and size > max_size:
+        return None
+    return fetch_range(url, 0, size - 1)[0] if size else b""
+
+
+def bgzf_block_size(header):
+    """
+    :param header: the first 18 bytes of a BGZF block
+    :return: the size of the whole (compressed) block, or None if it isn't a BGZF block
+    """
+    if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+        return None
+    # the BC extra subfield of each block's gzip header holds the size of the block, less one
+    return struct.unpack_from("<H", header, 16)[0] + 1
+
+
+def bgzf_blocks(data):
+    """
+    Decompress BGZF data (eg the start of a BAM), block by block, stopping at the first incomplete block.
+    :return: generator of the decompressed content of each block
+    """
+    offset = 0
+    while offset + 18 <= len(data):
+        block_size = bgzf_block_size(data[offset:offset + 18])
+        if block_size is None:
+            raise ValueError("Not BGZF data")
+        if offset + block_size > len(data):
+            return
+        yield zlib.decompress(data[offset + 18:offset + block_size - 8], -15)
+        offset += block_size
+
+
+def bam_reference_names(read, max_size=1 << 24):
+    """
+    Read the reference sequence names from the header of a BAM, fetching more of the BAM until the header is complete.
+    :param read: function(start, end) that returns the bytes of the BAM from offset `start` to `end`, inclusive
+    :param max_size: give up if the header isn't within this many bytes
+    :return: list of reference names, in the order that the BAI lists them
+    """
+    size = 1 << 16
+    while True:
+        header = b"".join(bgzf_blocks(read(0, size - 1)))
+        try:
+            magic, l_text = struct.unpack_from("<4si", header, 0)
+            if magic != b"BAM\1":
+                raise ValueError("Not a BAM file")
+            offset = 8 + l_text
+            n_ref, = struct.unpack_from("<i", header, offset)
+            offset += 4
+            names = []
+            for i in range(n_ref):
+                l_name, = struct.unpack_from("<i", header, offset)
+                if offset + 4 + l_name + 4 > len(header):
+                    raise struct.error("The header continues")
+                names.append(header[offset + 4:offset + 4 + l_name - 1].decode("utf-8"))
+                offset += 4 + l_name + 4
+            return names
+        except struct.error:
+            if size >= max_size:
+                raise ValueError("The BAM header is larger than {} bytes".format(max_size))
+            size *= 4
+
+
+def bai_coverage(bai, names, window=1 << 14):
+    """
+    Approximate the read density along each reference sequence, from a BAI alone. The BAI's linear index holds the
+    (virtual) file offset of the first read within each 16kb window, so the difference between neighbouring offsets is
+    the compressed size of the reads within a window. This is scaled by the number of mapped reads that the BAI
+    records for each reference, to give an approximate number of reads per window.
+    :param bai: the content of a BAI
+    :param names: the BAM's reference names, see `bam_reference_names`
+    :param window: the width of each window of the linear index
+    :return: generator of (reference name, start, end, approximate number of reads) for each window with reads
+    :raise ValueError: if it's not a BAI, or it doesn't match the BAM's reference names
+    """
+    magic, n_ref = struct.unpack_from("<4si", bai, 0)
+    if magic != b"BAI\1":
+        raise ValueError("Not a BAI file")
+    if n_ref > len(names):
+        raise ValueError("The BAI has {} references, but the BAM has {}".format(n_ref, len(names)))
+    offset = 8
+    for ref in range(n_ref):
+        n_bin, = struct.unpack_from("<i", bai, offset)
+        offset += 4
+        n_mapped, ref_begin, ref_end = None, None, None
+        for i in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", bai, offset)
+            offset += 8
+            if bin_id == 37450 and n_chunk == 2:
+                # a pseudo-bin, holding the offsets of the first and last reads, and the number of reads
+                ref_begin, ref_end, n_mapped, n_unmapped = struct.unpack_from("<4Q", bai, offset)
+            offset += 16 * n_chunk
+        n_intv, = struct.unpack_from("<i", bai, offset)
+        offset += 4
+        offsets = [voffset >> 16 for voffset in struct.unpack_from("<{}Q".format(n_intv), bai, offset)]
+        offset += 8 * n_intv
+        if not n_intv or not n_mapped:
+            continue
+        offsets.append(max(ref_end >> 16, offsets[-1]))
+        # windows without reads may have no offset (0, or anything before the first read), so they take the offset of
+        # the next window, and have a size of 0
+        for i in reversed(range(n_intv)):
+            if offsets[i] < ref_begin >> 16:
+                offsets[i] = offsets[i + 1]
+        sizes = [max(offsets[i + 1] - offsets[i], 0) for i in range(n_intv)]
+        reads_per_byte = float(n_mapped) / (sum(sizes) or 1)
+        for i, size in enumerate(sizes):
+            if size:
+                yield names[ref], i * window, (i + 1) * window, size * reads_per_byte
+
+
+def tdf_prewarm_ranges(read, zooms=TDF_PREWARM_ZOOMS):
+    """
+    Find the parts of a TDF file that IGV reads before it can draw coverage: the header, the master index, the groups,
+    and the datasets (and their tiles) for the genome-wide view ("All"), and for the zoom levels below `zooms`. TDF is
+    little-endian, and its layout is described at https://github.com/igvteam/igv/wiki/File-formats.
+    :param read: function(start, end) that returns the bytes of the file from offset `start` to `end`, inclusive
+    :return: list of (start, end) byte ranges
+    :raise ValueError: if it's not a TDF file
+    """
+    magic, version, index_position, index_size, header_size = struct.unpack("<4siqii", read(0, 23))
+    if not magic.startswith(b"TDF"):
+        raise ValueError("Not a TDF file")
+    ranges = [(0, 23 + header_size), (index_position, index_position + index_size - 1)]
+
+    def readString(data, offset):
+        end = data.index(b"\0", offset)
+        return data[offset:end].decode("utf-8"), end + 1
+
+    def isPrewarmed(name):
+        parts = name.strip("/").split("/")
+        if parts[0] == "All":
+            return True
+        return len(parts) > 1 and parts[1].startswith("z") and parts[1][1:].isdigit() and int(parts[1][1:]) < zooms
+
+    index = read(index_position, index_position + index_size - 1)
+    offset = 0
+    datasets = []
+    for section in ("datasets", "groups"):
+        count, = struct.unpack_from("<i", index, offset)
+        offset += 4
+        for i in range(count):
+            name, offset = readString(index, offset)
+            position, size = struct.unpack_from("<qi", index, offset)
+            offset += 12
+            if section == "groups":
+                ranges.append((position, position + size - 1))
+            elif isPrewarmed(name):
+                ranges.append((position, position + size - 1))
+                datasets.append((position, size))
+
+    for position, size in datasets:
+        dataset = read(position, position + size - 1)
+        n_attributes, = struct.unpack_from("<i", dataset, 0)
+        offset = 4
+        for i in range(n_attributes * 2):
+            _, offset = readString(dataset, offset)
+        _, offset = readString(dataset, offset)  # the data type
+        offset += 4  # the tile width
+        n_tiles, = struct.unpack_from("<i", dataset, offset)
+        offset += 4
+        for i in range(n_tiles):
+            tile_position, tile_size = struct.unpack_from("<qi", dataset, offset)
+            offset += 12
+            if tile_size > 0:
+                ranges.append((tile_position, tile_position + tile_size - 1))
+    return ranges
+
+
+def parse_byte_range(header, size):
+    """
+    Parse an HTTP Range header, of a single range of bytes.
+    :param header: the Range header, or None
+    :param size: the size of the content, in bytes
+    :return: (offset of the first byte, offset of the last byte), or None if the whole content should be sent, ie if
+    there is no Range, or it's one that we don't support (eg several ranges)
+    :raise ValueError: if the range can't be satisfied
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            # the last N bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError("{} is beyond the {} bytes of content".format(header, size))
+    return start, end
+
+
+def serve_igvdata(igvdata_path, port, threads=16, readahead=4 << 20, cache_size=None, cache_quotas=None):
+    """
+    Serve an igvdata root over HTTP, until stopped with Ctrl-C. This replaces `python -m SimpleHTTPServer`, for local
+    IGV data servers:
+    * connections are handled by a pool of `threads` threads, and are kept alive (HTTP/1.1)
+    * responses have a strong ETag (a hash of the content of text files, or the inode, size and mtime of others) and
+      Last-Modified, and conditional requests get a 304
+    * text files (eg registry TXT, XML and JSON) are gzipped, either from a precompressed <file>.gz that is at least as
+      new as the file, or on the fly (and cached)
+    * everything must be revalidated before it's reused (with its ETag), and XML and JSON manifests may only be kept
+      until their soonest URL expires
+    * hidden files (eg .htaccess, and the .state folder) and directory listings are never served
+    * the registry TXT of a shared registry (see `IgvRegistry`'s `shared`) is built from the local state, listing the
+      group's manifests within the shared store. There is no per-group access control: anyone who can reach the
+      server can read any group's TXT, and any manifest in the store
+    The igvdata root is served at /<name of the root>/, eg http://localhost:8000/igvdata/$$_dataServerRegistry.txt
+
+    It is also a caching proxy for the DNAnexus files within manifests built with a `proxy` (see `IgvRegistry`), at
+    /dx/<file-id>/<file name>. Range requests are served from a BlockCache in igvdata/.cache, and any blocks that aren't
+    cached are fetched from the file's pre-authenticated URL, as recorded in the local state. So views of loci that
+    have been viewed before don't need DNAnexus at all. Cached blocks, and files, are sent without copying them
+    through Python (see `send_file_range`), and /stats reports how many bytes were sent that way, and how many were
+    copied. The cache may be kept within `cache_size` bytes, and each
+    group's data within its quota, by an EvictionPolicy that keeps indexes and coverage files over data. A file is
+    charged to the first group (by name) with a registry that includes it.
+    :param igvdata_path: the igvdata root
+    :param port: port to listen on
+    :param threads: the number of connections to handle at once
+    :param readahead: bytes for the proxy to fetch ahead of sequential reads of BGZF files (eg BAMs), or 0
+    :param cache_size: bytes for the proxy to cache, or None for no limit
+    :param cache_quotas: dict of group -> bytes of data (ie not indexes or coverage) for the proxy to cache for it
+    """
+    root = os.path.abspath(igvdata_path).rstrip("/")
+    real_root = os.path.realpath(root)
+    prefix = "/" + os.path.basename(root) + "/"
+    # (path, gzip) -> ((size, mtime), (etag, gzipped content or None)), for the newest version of each path. Only text
+    # files are hashed, so this stays small.
+    digests = {}
+    digests_lock = threading.Lock()
+    local = threading.local()
+    # bytes of content sent by send_file_range, and bytes copied through Python (eg gzipped, or just fetched)
+    transfers = {"zero_copy": 0, "copied": 0}
+    transfers_lock = threading.Lock()
+
+    def getDigest(path, stat, gzipped):
+        key, version = (path, gzipped), (stat.st_size, stat.st_mtime)
+        with digests_lock:
+            if key in digests and digests[key][0] == version:
+                return digests[key][1]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        content = None
+        if gzipped:
+            with open(path, "rb") as f:
+                content = gzip_bytes(f.read())
+        digest = ('"{}{}"'.format(sha1.hexdigest(), "-gzip" if gzipped else ""), content)
+        with digests_lock:
+            # replace the digest of an older version, but not of a newer one that another thread has just hashed
+            if key not in digests or digests[key][0][1] <= stat.st_mtime:
+                digests[key] = (version, digest)
+        return digest
+
+    def getState():
+        if not hasattr(local, "state"):
+            # sqlite connections can't be shared between threads
+            local.state = RegistryState(root)
+        return local.state
+
+    cache = BlockCache(os.path.join(root, ".cache"), readahead=readahead, budget=cache_size, quotas=cache_quotas,
+                       get_group=lambda file_id: getState().getFileGroup(file_id))
+    if cache.policy is not None:
+        cache.scanPeriodically()
+
+    def getMaxAge(relative_path):
+        """
+        :return: seconds until the soonest URL within a manifest expires, or None. Manifests are revalidated on every
+        use anyway (as a rebuild changes them), so this is only an upper bound on how long they may be kept.
+        """
+        folder, name = os.path.split(relative_path)
+        stem, ext = os.path.splitext(name)
+        if ext not in (".xml", ".json"):
+            return None
+        expires = getState().getManifestExpiry(folder, stem + ".xml")
+        return max(0, int(expires - time.time())) if expires else None
+
+    def getSharedRegistryTXT(relative_path):
+        """:return: (the registry TXT, when it last changed) for a shared registry, or None if it isn't shared"""
+        group, name = os.path.split(relative_path)
+        ref_genome = name[:-len("_dataServerRegistry.txt")]
+        if ref_genome in ("hg19", "b37"):
+            ref_genome = "1kg_v37"
+        shared = getState().getSharedRegistry("{}/{}".format(group, ref_genome))
+        if shared is None:
+            return None
+        url_root, store, manifests = shared
+        urls = [quote(os.path.join(url_root, store, path), safe=URL_SAFE) for path, written in manifests]
+        return "".join(url + "\n" for url in urls).encode("utf-8"), max([0] + [row[1] for row in manifests])
+
+    class IgvdataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # close idle keep-alive connections, so they don't hold a thread forever
+        timeout = 30
+
+        def do_GET(self):
+            self.serve(send_body=True)
+
+        def do_HEAD(self):
+            self.serve(send_body=False)
+
+        def serve(self, send_body):
+            url_path = unquote(self.path.split("?", 1)[0])
+            if url_path == "/stats":
+                return self.serveStats(send_body)
+            if url_path.startswith("/dx/"):
+                return self.serveProxy(url_path.split("/")[2], send_body)
+            # a leading / would make os.path.join drop the root, eg /igvdata//etc/passwd
+            relative_path = os.path.normpath(url_path[len(prefix):].lstrip("/")) if url_path.startswith(prefix) else ""
+            path = os.path.join(root, relative_path)
+            if (not relative_path or relative_path.startswith("..") or
+                    any(part.startswith(".") for part in relative_path.split("/")) or
+                    not os.path.realpath(path).startswith(real_root + os.sep)):
+                return self.sendError(404)
+            if not os.path.isfile(path) and path.endswith("_dataServerRegistry.txt"):
+                shared = getSharedRegistryTXT(relative_path)
+                if shared is not None:
+                    return self.serveRegistryTXT(shared[0], shared[1], send_body)
+            if not os.path.isfile(path):
+                return self.sendError(404)
+
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            compressible = content_type.startswith("text/") or content_type in ("application/xml", "application/json")
+            accepts_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+            serve_path, gzipped = path, False
+            if accepts_gzip and compressible:
+                if os.path.exists(path + ".gz") and os.stat(path + ".gz").st_mtime >= os.stat(path).st_mtime:
+                    serve_path = path + ".gz"
+                else:
+                    gzipped = True
+            stat = os.stat(serve_path)
+            if compressible:
+                etag, content = getDigest(serve_path, stat, gzipped)
+            else:
+                # hashing a large file (eg a bigWig, or a local BAM) would hold up its first request for the whole read
+                etag, content = '"{:x}-{:x}-{:x}"'.format(stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000)), None
+            if serve_path != path:
+                etag = etag[:-1] + '-gzip"'
+
+            modified = self.isModified(etag, stat.st_mtime)
+            byte_range = None
+            if modified and serve_path == path and not gzipped:
+                # eg bigWig files, which IGV reads in parts
+                try:
+                    byte_range = parse_byte_range(self.headers.get("Range"), stat.st_size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */{}".format(stat.st_size))
+                    self.send_header("Content-Length", "0")
+                    return self.end_headers()
+
+            self.send_response(304 if not modified else 206 if byte_range else 200)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", self.date_time_string(int(stat.st_mtime)))
+            max_age = getMaxAge(relative_path)
+            self.send_header("Cache-Control", "no-cache, max-age={}".format(max_age) if max_age is not None else
+                             "no-cache")
+            if compressible:
+                self.send_header("Vary", "Accept-Encoding")
+            if not modified:
+                return self.end_headers()
+
+            self.send_header("Content-Type", content_type)
+            if gzipped or serve_path != path:
+                self.send_header("Content-Encoding", "gzip")
+            else:
+                self.send_header("Accept-Ranges", "bytes")
+            start, end = byte_range or (0, (len(content) if content is not None else stat.st_size) - 1)
+            if byte_range:
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, stat.st_size))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if not send_body:
+                return
+            if content is not None:
+                self.sendContent(content)
+            else:
+                with open(serve_path, "rb") as f:
+                    self.sendContent((f, start, end - start + 1))
+
+        def serveProxy(self, file_id, send_body):
+            """Serve (a range of) a DNAnexus file, from the BlockCache"""
+            if not file_id.startswith("file-"):
+                return self.sendError(404)
+            url = getState().getUrl(file_id)
+            try:
+                size = cache.getSize(file_id, url)
+            except IOError as e:
+                self.log_error("Can't fetch %s: %s", file_id, e)
+                return self.sendError(404 if url is None else 502)
+            # file-id's are never reused, and their content never changes, so the file-id makes a strong ETag
+            etag = '"{}"'.format(file_id)
+            if not self.isModified(etag, 0):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                return self.end_headers()
+            try:
+                byte_range = parse_byte_range(self.headers.get("Range"), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(size))
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+
+            start, end = byte_range or (0, size - 1)
+            cache.noteRead(file_id, url, start, end, size)
+            chunks = iter(cache.openRead(file_id, url, start, end) if send_body and size else [])
+            try:
+                # fetch the first block before replying, so that an unreachable upstream can still get a 502
+                first = next(chunks, b"")
+            except IOError as e:
+                self.log_error("Can't fetch %s: %s", file_id, e)
+                return self.sendError(502)
+            self.send_response(206 if byte_range else 200)
+            if byte_range:
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+            self.send_header("ETag", etag)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Cache-Control", "max-age={}".format(ONE_YEAR))
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if send_body and size:
+                try:
+                    self.sendContent(first)
+                    for chunk in chunks:
+                        self.sendContent(chunk)
+                except IOError as e:
+                    # the headers have been sent, so all we can do is drop the connection
+                    self.log_error("Can't fetch %s: %s", file_id, e)
+                    self.close_connection = 1
+
+        def serveRegistryTXT(self, content, mtime, send_body):
+            """Serve a registry TXT that was built in memory, which is small, so it's gzipped on every request."""
+            gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+            etag = '"{}{}"'.format(hashlib.sha1(content).hexdigest(), "-gzip" if gzipped else "")
+            modified = self.isModified(etag, mtime)
+            self.send_response(200 if modified else 304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", self.date_time_string(int(mtime)))
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept-Encoding")
+            if not modified:
+                return self.end_headers()
+            if gzipped:
+                content = gzip_bytes(content)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(content)
+
+        def serveStats(self, send_body):
+            """Serve the bytes sent without copying, and copied, and the size of the proxy's cache, as JSON"""
+            with transfers_lock:
+                stats = dict(("{}_bytes".format(key), value) for key, value in transfers.items())
+            if cache.policy is not None:
+                stats["cache_bytes"] = cache.policy.getTotal()
+                stats["pinned_bytes"] = cache.policy.pinned_bytes
+            content = json.dumps(stats, sort_keys=True).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(content)
+
+        def sendContent(self, content):
+            """
+            Send part of a response's body, counting the bytes sent.
+            :param content: a byte string, or (open file, offset, length) to send without copying
+            """
+            if isinstance(content, tuple):
+                # the headers must reach the socket first
+                self.wfile.flush()
+                send_file_range(self.connection, *content)
+                key, length = "zero_copy", content[2]
+            else:
+                self.wfile.write(content)
+                key, length = "copied", len(content)
+            with transfers_lock:
+                transfers[key] += length
+
+        def isModified(self, etag, mtime):
+            """:return: False if the client's conditional request headers show that it already has this content"""
+            if_none_match = self.headers.get("If-None-Match")
+            if if_none_match is not None:
+                return not (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")])
+            if_modified_since = self.headers.get("If-Modified-Since")
+            if if_modified_since and mtime:
+                since = email_utils.parsedate_tz(if_modified_since)
+                if since is not None and int(mtime) <= email_utils.mktime_tz(since):
+                    return False
+            return True
+
+        def sendError(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+        """An HTTPServer that handles each connection using a fixed pool of threads."""
+
+        def __init__(self, address, handler):
+            BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+            self.connections = Queue.Queue(threads * 4)
+            for i in range(threads):
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+
+        def process_request(self, request, client_address):
+            self.connections.put((request, client_address))
+
+        def work(self):
+            while True:
+                request, client_address = self.connections.get()
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+    server = PooledHTTPServer(("", port), IgvdataHandler)
+    print("Serving {} at http://localhost:{}{}, with {} threads".format(root, port, prefix, threads))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print("Sent {} MB without copying, and copied {} MB".format(transfers["zero_copy"] >> 20, transfers["copied"] >> 20))
+
+
+def send_file_range(connection, source, offset, length):
+    """
+    Send part of a file to a socket, without copying it through Python, from a memory mapping of the file.
+    :param connection: the socket, with nothing left to flush from its file object
+    :param source: an open file
+    """
+    if not length:
+        return
+    # only the range is mapped, from the page that it starts within
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mapping = mmap.mmap(source.fileno(), offset - start + length, access=mmap.ACCESS_READ, offset=start)
+    try:
+        # a buffer is a view of the mapping, whereas slicing the mapping would copy it
+        connection.sendall(buffer(mapping, offset - start, length))
+    finally:
+        mapping.close()
+
+
+def gzip_bytes(data):
+    """:return: `data`, gzipped"""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+
+def print_timings(parsed_time):
+    """
+    Report the startup time (ie interpreter start to parsed arguments), and how long each deferred import took.
+    :param parsed_time: time.time() once the command line arguments were parsed
+    """
+    print("Timings (ms):")
+    print("  {:>8.1f}  startup, until arguments were parsed".format((parsed_time - START_TIME) * 1000))
+    for name, seconds in IMPORT_TIMES:
+        print("  {:>8.1f}  import {}".format(seconds * 1000, name))
+    print("  {:>8.1f}  total".format((time.time() - START_TIME) * 1000))
+
+
 def main(args):
     assert(args.ref_genome in ["1kg_v37", "mm10", "hg19"])
+    formats = args.formats.split(",")
+    for fmt in formats:
+        assert fmt in OUTPUT_FORMATS, "Unknown output format: {}".format(fmt)
+    describes = None
+    if args.projects_from:
+        # resolve the whole batch of projects at once
+        project_ids, describes = resolve_projects((args.project_ids or []) + read_projects(args.projects_from))
+        args.project_ids = project_ids
+        print("Read {} projects from {}".format(len(project_ids), args.projects_from))
 
-    if args.xml_only:
+    assert args.proxy or not args.prewarm, "--prewarm needs a --proxy"
+    if args.worker:
+        assert args.queue, "--worker needs a --queue"
+        run_worker(args.queue, lease=args.lease)
+    elif args.xml_only:
         """Only create the XML file in current working dir. Don't add it to a registry"""
         for project_id in args.project_ids:
-            dx_project = DxDataset(project=project_id, ref_genome=args.ref_genome, url_duration=args.duration)
+            dx_project = DxDataset(project=project_id, ref_genome=args.ref_genome, url_duration=args.duration,
+                                   describe=(describes or {}).get(project_id))
             dx_project.addData()
-            xml_path = dx_project.writeXML(".")
-            print("Wrote {} ({}) to {}".format(dx_project.project.name, dx_project.project.id, xml_path))
+            dx_project.proxy = args.proxy
+            for fmt, path in sorted(dx_project.write(".", formats).items()):
+                print("Wrote {} ({}) to {}".format(dx_project.name, dx_project.project.id, path))
     else:
         """Create an XML manifest, and add it to an Igv Data Server registry"""
         hostname = socket.gethostname()
         if not args.igvdata_path or not args.igvdata_url:
             if hostname == 'ip-172-31-18-95':
                 print("Running on seave.bio")
-                args.igvdata_url = 'https://seave.bio/igvdata'
-                args.igvdata_path = '/var/www/html/igvdata/'
+                igvdata_url = 'https://seave.bio/igvdata'
+                igvdata_path = '/var/www/html/igvdata/'
             elif hostname == 'ip-172-31-11-39':
                 print("Running on dev.seave.bio")
-                args.igvdata_url = 'https://dev.seave.bio/igvdata'
-                args.igvdata_path = '/var/www/html/igvdata/'
+                igvdata_url = 'https://dev.seave.bio/igvdata'
+                igvdata_path = '/var/www/html/igvdata/'
             else:
                 print("This isn't running on a Seave server, so defaulting to localhost")
-                # args.igvdata_path = '~/var/www/html/igvdata'  # local testing of Seave mode
-                args.igvdata_path = os.path.join(os.path.expanduser('~'), "igvdata")
-                args.igvdata_url = 'https://localhost:8000/igvdata/'
-        os.path.exists(args.igvdata_path) or os.mkdir(args.igvdata_path)
+                # igvdata_path = '~/var/www/html/igvdata'  # local testing of Seave mode
+                igvdata_path = os.path.join(os.path.expanduser('~'), "igvdata")
+                igvdata_url = 'https://localhost:8000/igvdata/'
+            # --igvdata_path and --url each replace only their own default, so --igvdata_path keeps this host's URL
+            args.igvdata_url = args.igvdata_url or igvdata_url
+            args.igvdata_path = args.igvdata_path or igvdata_path
+        makedirs(args.igvdata_path)
+
+        if args.serve:
+            quotas = dict((group, int(size)) for group, size in
+                          (quota.rsplit("=", 1) for quota in args.cache_quotas or []))
+            serve_igvdata(args.igvdata_path, args.serve, threads=args.threads, readahead=args.readahead,
+                          cache_size=args.cache_size, cache_quotas=quotas)
+            return
+        if args.serve_webhook:
+            serve_webhook(args.igvdata_path, args.serve_webhook, debounce=args.debounce, token=args.webhook_token,
+                          jobs=args.jobs)
+            return
+        if args.serve_updates:
+            serve_updates(args.igvdata_path, interval=args.interval, refresh_within=args.refresh_within, jobs=args.jobs)
+            return
 
-        reg = IgvRegistry(ref_genome=args.ref_genome, folder=args.igvdata_path, url_root=args.igvdata_url,
-                          url_duration=args.duration, group=args.group)
+        read_only = args.rollback or args.rewrite_txt or args.report
+        reg = None
+        if read_only:
+            # use the settings that the registry was built with, rather than whichever flags were given now
+            reg = open_registry(args.igvdata_path, args.group, args.ref_genome, jobs=args.jobs)
+        if reg is None:
+            reg = IgvRegistry(ref_genome=args.ref_genome, folder=args.igvdata_path, url_root=args.igvdata_url,
+                              url_duration=args.duration, group=args.group, formats=formats,
+                              flush_every=args.flush_every, jobs=args.jobs, refresh_within=args.refresh_within,
+                              shared=args.shared, proxy=args.proxy, prewarm=args.prewarm,
+                              mirror_under=args.mirror_under, bai_coverage=args.bai_coverage, record=not read_only)
+        if args.queue:
+            reg.queue = WorkQueue(args.queue, lease=args.lease)
 
         if args.project_ids:
-            reg.addProjects(args.project_ids)
+            reg.addProjects(args.project_ids, describes=describes)
         elif args.test:
             reg.testUpdate()
             sys.exit(0)
+        elif args.sync_tag:
+            reg.syncTag(args.sync_tag)
+        elif args.update:
+            reg.update()
         elif args.force:
             reg.forceUpdate()
+        elif args.rollback:
+            reg.rollback()
+        elif args.rewrite_txt:
+            reg.rewriteRegistryTXT()
+        elif args.report:
+            for line in reg.report():
+                print(line)
 
 
 if __name__ == '__main__':
@@ -451,6 +3512,8 @@ if __name__ == '__main__':
 
     parser.add_argument('-p', '--project_id', dest='project_ids', action='append', type=str, required=False,
                         help='Update specific project_id(s), or project_name(s). Can be specified any number of times')
+    parser.add_argument('--projects_from', help="Update the project_id(s), or project_name(s), listed one per line in "
+                                                "this file, or '-' to read them from stdin", type=str, required=False)
     parser.add_argument('-g', '--group', help='Remote IGV server Group to associate data with', type=str,
                         required=False)
     parser.add_argument('-d', '--duration', help='Duration to generate URLs for, in seconds', type=int, required=False,
@@ -459,10 +3522,78 @@ if __name__ == '__main__':
                         default="1kg_v37")
     parser.add_argument('-x', '--xml_only', help='[Advanced] Create an XML file, but dont add it to a registry', 
                         action='store_true')
+    parser.add_argument('--formats', help='Comma separated output formats, from one crawl: xml (IGV dataset), '
+                                          'json (igv.js tracks), session (one IGV session per sample)',
+                        type=str, default="xml")
     parser.add_argument('--igvdata_path', help='[Advanced] Override the path to local igvdata', type=str, required=False)
-    parser.add_argument('--url', help='[Advanced] Override the web accessible URL to igvdata', type=str, required=False)
+    parser.add_argument('--url', help='[Advanced] Override the web accessible URL to igvdata', dest='igvdata_url',
+                        type=str, required=False)
+    parser.add_argument('--flush_every', help='[Advanced] Write new entries to the registry TXT after every N projects, '
+                                              'as well as at the end of the run', type=int, required=False)
+    parser.add_argument('-j', '--jobs', help='Number of projects to crawl at once', type=int, default=1)
+    parser.add_argument('--queue', help='[Advanced] Path to a work queue on shared storage. Projects are crawled by '
+                                        '--worker processes, on any host, and then added to the registry by this one',
+                        type=str, required=False)
+    parser.add_argument('--worker', help='[Advanced] Crawl projects from the --queue, until stopped',
+                        action='store_true')
+    parser.add_argument('--lease', help='[Advanced] Seconds before a crawl from the --queue, whose worker has stopped '
+                                        'responding, is given to another worker', type=int, default=ONE_HOUR)
     parser.add_argument('-t', '--test', help='Test mode, over a few projects only', action='store_true')
-    parser.add_argument('-f', '--force', help='Force recreation of XML files within a registry', action='store_true')
+    parser.add_argument('--sync_tag', help='Make the registry match the DNAnexus projects with this tag: add new '
+                                           'projects, rebuild modified ones, and remove those that lost the tag',
+                        type=str, required=False)
+    parser.add_argument('-u', '--update', help='Rebuild only the projects in a registry that have changed on DNAnexus '
+                                               'since they were last built', action='store_true')
+    parser.add_argument('--refresh_within', help='When updating, also rebuild projects whose URLs expire within this '
+                                                 'many seconds', type=int, default=ONE_WEEK)
+    parser.add_argument('--serve_updates', help='Run as a daemon, keeping every registry within igvdata up to date',
+                        action='store_true')
+    parser.add_argument('--interval', help='Seconds between polls of DNAnexus, for --serve_updates', type=int,
+                        default=ONE_HOUR)
+    parser.add_argument('--shared', help="Keep the group's manifests in a store shared with other groups, so shared "
+                                         "projects are crawled once. Its registry TXT is built on request by --serve",
+                        action='store_true')
+    parser.add_argument('--proxy', help="Point the manifests at the caching proxy of --serve at this URL (eg "
+                                        "http://localhost:8000), rather than at DNAnexus", type=str, required=False)
+    parser.add_argument('--prewarm', help="Fetch every index, and the low zoom levels of every TDF, into the --proxy's "
+                                          "cache as each project is built", action='store_true')
+    parser.add_argument('--mirror_under', help="Copy .seg, .cn, .bed.gz and .bw files smaller than this many bytes "
+                                               "into the registry, rather than linking to DNAnexus", type=int,
+                        required=False)
+    parser.add_argument('--bai_coverage', help="Give BAMs that have no TDF an approximate coverage track, derived "
+                                               "from their BAI", action='store_true')
+    parser.add_argument('--serve', help='Serve igvdata over HTTP on this port, instead of python -m SimpleHTTPServer',
+                        type=int, metavar='PORT', required=False)
+    parser.add_argument('--threads', help='Number of connections for --serve to handle at once', type=int, default=16)
+    parser.add_argument('--readahead', help="Bytes for --serve's proxy to fetch ahead of sequential reads of BAMs "
+                                            "(and other BGZF files), or 0", type=int, default=4 << 20)
+    parser.add_argument('--cache_size', help="Bytes for --serve's proxy to cache, evicting data (eg BAMs) before "
+                                             "indexes and coverage. By default, everything is kept", type=int,
+                        required=False)
+    parser.add_argument('--cache_quota', help="GROUP=BYTES of data for --serve's proxy to cache for a group's files. "
+                                              "Can be given for several groups", dest='cache_quotas', action='append',
+                        type=str, required=False, metavar='GROUP=BYTES')
+    parser.add_argument('--serve_webhook', help='Listen on this port for POST /reindex?project=...&folder=... '
+                                                'requests, and rebuild just that project, or folder', type=int,
+                        metavar='PORT', required=False)
+    parser.add_argument('--debounce', help='Seconds to wait for further reindex requests for a project, before '
+                                           'rebuilding it', type=int, default=30)
+    parser.add_argument('--webhook_token', help='A secret that reindex requests must include', type=str,
+                        required=False)
+    parser.add_argument('-f', '--force', help='Force recreation of XML files within a registry. The registry stays '
+                                              'online, and the previous version is kept', action='store_true')
+    parser.add_argument('--report', help='Summarise the projects in a registry, and when their URLs expire, from local '
+                                         'state only', action='store_true')
+    parser.add_argument('--rewrite_txt', help='Rewrite the registry TXT from the local state, without using DNAnexus',
+                        action='store_true')
+    parser.add_argument('--timings', help='Report how long startup, and each deferred import, took', action='store_true')
+    parser.add_argument('--rollback', help='Restore the registry to how it was before the last --force',
+                        action='store_true')
 
     args = parser.parse_args()
-    main(args)
+    parsed_time = time.time()
+    try:
+        main(args)
+    finally:
+        if args.timings:
+            print_timings(parsed_time)
@@ -0,0 +1,34 @@
+"""
+Load dx-igv-registry.py, whose name can't be imported, as `registry`. Run the tests from the repository root with:
+
+    python -m unittest discover -s tests
+"""
+import imp
+import os
+import struct
+import sys
+import zlib
+
+sys.dont_write_bytecode = True
+registry = imp.load_source("dx_igv_registry", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                                           "dx-igv-registry.py"))
+
+
+def bgzf(data):
+    """:return: `data`, compressed as one BGZF block"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    # the BC extra subfield holds the size of the whole block, less one
+    header = b"\x1f\x8b\x08\x04\0\0\0\0\0\xff" + struct.pack("<H", 6) + b"BC" + struct.pack("<HH", 2,
+                                                                                             len(compressed) + 25)
+    return header + compressed + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class FakeDxpy(object):
+    """Stands in for the dxpy module, for tests of code that holds DXProjects but doesn't call DNAnexus"""
+    class DXProject(object):
+        def __init__(self, dxid):
+            self.dxid = dxid
+
+        def get_id(self):
+            return self.dxid
@@ -0,0 +1,99 @@
+import random
+import struct
+import unittest
+
+from support import bgzf, registry
+
+
+def bam_header(names, text=b""):
+    """:return: the uncompressed header of a BAM with these reference names"""
+    header = b"BAM\1" + struct.pack("<i", len(text)) + text + struct.pack("<i", len(names))
+    for name in names:
+        header += struct.pack("<i", len(name) + 1) + name.encode("utf-8") + b"\0" + struct.pack("<i", 1000000)
+    return header
+
+
+def bai(references):
+    """
+    :param references: list of (n_mapped, list of the compressed offset of the first read within each 16kb window),
+    or None for a reference without reads
+    :return: a BAI
+    """
+    data = b"BAI\1" + struct.pack("<i", len(references))
+    for reference in references:
+        if reference is None:
+            data += struct.pack("<ii", 0, 0)
+            continue
+        n_mapped, offsets = reference
+        # windows before the first read have an offset of 0
+        begin = next(offset for offset in offsets if offset)
+        # one bin with one chunk, and the pseudo-bin with the offsets of the first and last reads, and the read counts
+        data += struct.pack("<i", 2)
+        data += struct.pack("<Ii", 4681, 1) + struct.pack("<QQ", begin << 16, offsets[-1] << 16)
+        data += struct.pack("<Ii", 37450, 2) + struct.pack("<QQQQ", begin << 16, (offsets[-1] + 100) << 16,
+                                                           n_mapped, 0)
+        data += struct.pack("<i", len(offsets)) + b"".join(struct.pack("<Q", offset << 16) for offset in offsets)
+    return data
+
+
+def reader(data):
+    return lambda start, end: data[start:end + 1]
+
+
+class BamReferenceNamesTest(unittest.TestCase):
+    def testNames(self):
+        bam = bgzf(bam_header(["chr1", "chr2", "chrM"]))
+        self.assertEqual(registry.bam_reference_names(reader(bam)), ["chr1", "chr2", "chrM"])
+
+    def testHeaderBeyondFirstRead(self):
+        # a long header, over several BGZF blocks, that isn't within the first 64kb that are read
+        rng = random.Random(0)
+        text = bytes(bytearray(rng.getrandbits(8) for i in range(200000)))
+        header = bam_header(["chr%d" % i for i in range(1, 23)], text)
+        bam = b"".join(bgzf(header[i:i + 60000]) for i in range(0, len(header), 60000))
+        self.assertGreater(len(bam), 1 << 16)
+        self.assertEqual(registry.bam_reference_names(reader(bam))[-1], "chr22")
+
+    def testNotBam(self):
+        self.assertRaises(ValueError, registry.bam_reference_names, reader(bgzf(b"BAI\1" + b"\0" * 100)))
+        self.assertRaises(ValueError, registry.bam_reference_names, reader(b"\0" * 100))
+
+    def testBgzfBlockSize(self):
+        block = bgzf(b"some data")
+        self.assertEqual(registry.bgzf_block_size(block[:18]), len(block))
+        self.assertIsNone(registry.bgzf_block_size(b"\x1f\x8b\x08\0" + b"\0" * 14))
+        self.assertIsNone(registry.bgzf_block_size(block[:10]))
+        self.assertEqual(list(registry.bgzf_blocks(block + bgzf(b"more") + block[:20])), [b"some data", b"more"])
+
+
+class BaiCoverageTest(unittest.TestCase):
+    def testWindows(self):
+        # chr1 has 1000 reads, in windows 0, 1 and 3 (window 2 is empty), whose compressed sizes are 400, 100 and 100
+        # bytes (the last read ends 100 bytes after window 3 starts), and chr2 has no reads
+        windows = list(registry.bai_coverage(bai([(1000, [100, 500, 600, 600]), None]), ["chr1", "chr2"]))
+        self.assertEqual([window[:3] for window in windows],
+                         [("chr1", 0, 16384), ("chr1", 16384, 32768), ("chr1", 49152, 65536)])
+        self.assertAlmostEqual(sum(window[3] for window in windows), 1000)
+        # the reads are spread in proportion to the compressed size of each window
+        self.assertAlmostEqual(windows[0][3], 1000 * 400 / 600.0)
+
+    def testWindowsWithoutOffsets(self):
+        # chr2's reads start in window 2, after 100000 bytes of chr1, so windows 0 and 1 have an offset of 0, as does
+        # the empty window 4
+        references = [(1000, [100, 500, 600, 600]), (300, [0, 0, 100000, 100200, 0, 100300])]
+        windows = list(registry.bai_coverage(bai(references), ["chr1", "chr2"]))
+        chr2 = [window for window in windows if window[0] == "chr2"]
+        self.assertEqual([window[:3] for window in chr2],
+                         [("chr2", 32768, 49152), ("chr2", 49152, 65536), ("chr2", 81920, 98304)])
+        self.assertAlmostEqual(sum(window[3] for window in chr2), 300)
+        self.assertAlmostEqual(chr2[0][3], 300 * 200 / 400.0)
+
+    def testNotBai(self):
+        self.assertRaises(ValueError, list, registry.bai_coverage(b"BAM\1" + b"\0" * 4, []))
+
+    def testMoreReferencesThanBam(self):
+        self.assertRaises(ValueError, list, registry.bai_coverage(bai([(1000, [100, 500]), None]), ["chr1"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
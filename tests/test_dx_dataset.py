@@ -0,0 +1,45 @@
+import unittest
+
+from support import FakeDxpy, registry
+
+
+class ReindexFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, registry, "dxpy", registry.dxpy)
+        registry.dxpy = FakeDxpy
+        self.dataset = registry.DxDataset(FakeDxpy.DXProject("project-A"), describe={"name": "Run 1"})
+        for name in ("bams", "vcfs"):
+            folder = registry.Folder(name, "/" + name)
+            folder.resources.append(registry.Resource("file-" + name, "old." + name, folder.path, "https://dl/old"))
+            self.dataset.root.folders.append(folder)
+        self.crawled = []
+        # instead of listing the DX folder, record which folder would have been crawled, and find one new file in it
+        self.dataset.addLevel = self.addLevel
+        self.dataset.addData = lambda: self.crawled.append("whole project")
+
+    def addLevel(self, node, folder):
+        self.crawled.append(folder)
+        node.resources.append(registry.Resource("file-new", "new.bam", folder, "https://dl/new"))
+
+    def getNames(self):
+        return dict((folder.path, [resource.name for resource in folder.resources])
+                    for folder in self.dataset.root.walk())
+
+    def testFolder(self):
+        self.dataset.reindexFolder("/bams/")
+        self.assertEqual(self.crawled, ["/bams"])
+        # the rest of the previous crawl is kept
+        self.assertEqual(self.getNames(), {"/": [], "/bams": ["new.bam"], "/vcfs": ["old.vcfs"]})
+
+    def testNewSubFolder(self):
+        # its closest ancestor that was crawled before is re-crawled
+        self.dataset.reindexFolder("bams/run2/S1")
+        self.assertEqual(self.crawled, ["/bams"])
+
+    def testNewFolder(self):
+        self.dataset.reindexFolder("/run2")
+        self.assertEqual(self.crawled, ["whole project"])
+
+
+if __name__ == "__main__":
+    unittest.main()
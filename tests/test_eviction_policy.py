@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import registry
+
+
+class EvictionPolicyTest(unittest.TestCase):
+    def testKeepsWithinBudget(self):
+        policy = registry.EvictionPolicy(budget=10)
+        evicted = []
+        for i in range(25):
+            evicted.extend(policy.admit(("file-a", i), 1))
+        self.assertEqual(policy.getTotal(), 10)
+        self.assertEqual(len(evicted), 15)
+
+    def testScanDoesntEvictPinnedOrHotBlocks(self):
+        policy = registry.EvictionPolicy(budget=20)
+        evicted = []
+        for i in range(5):
+            evicted.extend(policy.admit(("file-bai", i), 1, pinned=True))
+        for i in range(5):
+            evicted.extend(policy.admit(("file-hot", i), 1))
+            policy.touch(("file-hot", i))
+        # one huge BAM, read once from end to end
+        for i in range(200):
+            evicted.extend(policy.admit(("file-wgs", i), 1))
+        self.assertEqual([key for key in evicted if key[0] != "file-wgs"], [])
+        self.assertEqual(policy.pinned_bytes, 5)
+        self.assertLessEqual(policy.getTotal(), 20)
+
+    def testPinnedOnlyEvictedOnceNoDataIsLeft(self):
+        policy = registry.EvictionPolicy(budget=3)
+        policy.admit(("file-bai", 0), 1, pinned=True)
+        policy.admit(("file-bai", 1), 1, pinned=True)
+        policy.admit(("file-bam", 0), 1)
+        self.assertEqual(policy.admit(("file-bai", 2), 1, pinned=True), [("file-bam", 0)])
+        # least recently used first
+        policy.touch(("file-bai", 0))
+        self.assertEqual(policy.admit(("file-bai", 3), 1, pinned=True), [("file-bai", 1)])
+
+    def testGhostsReturnToMainQueue(self):
+        policy = registry.EvictionPolicy(budget=4)
+        for i in range(10):
+            policy.admit(("file-a", i), 1)
+        self.assertIn(("file-a", 0), policy.ghosts)
+        policy.admit(("file-a", 0), 1)
+        self.assertIn(("file-a", 0), policy.main)
+        self.assertNotIn(("file-a", 0), policy.ghosts)
+
+    def testGroupQuota(self):
+        policy = registry.EvictionPolicy(budget=100, quotas={"LKCGP": 5})
+        evicted = []
+        for i in range(5):
+            evicted.extend(policy.admit(("file-other", i), 1, group="Other"))
+        for i in range(20):
+            evicted.extend(policy.admit(("file-lkcgp", i), 1, group="LKCGP"))
+        self.assertEqual(policy.group_bytes, {"Other": 5, "LKCGP": 5})
+        self.assertEqual(set(key[0] for key in evicted), {"file-lkcgp"})
+        # the oldest blocks go first
+        self.assertEqual(evicted[0], ("file-lkcgp", 0))
+
+    def testTouch(self):
+        policy = registry.EvictionPolicy()
+        self.assertFalse(policy.touch(("file-a", 0)))
+        self.assertEqual(policy.admit(("file-a", 0), 1), [])
+        self.assertTrue(policy.touch(("file-a", 0)))
+        # admitting a known block counts as a read, rather than adding it twice
+        self.assertEqual(policy.admit(("file-a", 0), 1), [])
+        self.assertEqual(policy.getTotal(), 1)
+
+
+
+class BlockCacheScanTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def cacheBlocks(self, file_id, blocks):
+        """Cache blocks of 1 byte, as another process would, without telling any BlockCache"""
+        os.mkdir(os.path.join(self.folder, file_id))
+        for block in blocks:
+            with open(os.path.join(self.folder, file_id, str(block)), "wb") as block_file:
+                block_file.write(b"x")
+
+    def testScanAdmitsBlocksCachedByOtherProcesses(self):
+        self.cacheBlocks("file-a", range(3))
+        cache = registry.BlockCache(self.folder, budget=5)
+        self.assertEqual(cache.policy.getTotal(), 3)
+        # eg --prewarm, in another process
+        self.cacheBlocks("file-b", range(4))
+        self.assertEqual(cache.loadPolicy(), 4)
+        self.assertEqual(cache.policy.getTotal(), 5)
+        remaining = sum(len(os.listdir(os.path.join(self.folder, file_id))) for file_id in ("file-a", "file-b"))
+        self.assertEqual(remaining, 5)
+        # known blocks aren't admitted again
+        self.assertEqual(cache.loadPolicy(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
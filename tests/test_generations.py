@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import FakeDxpy, registry
+
+
+class TaggedDxpy(FakeDxpy):
+    """Finds one project with any tag"""
+    queries = []
+
+    @classmethod
+    def find_projects(cls, **kwargs):
+        cls.queries.append(kwargs)
+        return [{"id": "project-B"}]
+
+
+class GenerationsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.reg = registry.IgvRegistry(folder=self.root, url_root="http://localhost:8000/igvdata")
+        self.addCleanup(self.reg.state.close)
+        self.build(self.reg, {"project-A": "A", "project-B": "B"}, "first")
+
+    def build(self, reg, projects, content):
+        """Write and record a manifest for each of `projects` (project-id -> name), and a TXT listing them"""
+        for project_id, name in sorted(projects.items()):
+            path = os.path.join(reg.folder, name + ".xml")
+            with open(path, "w") as manifest:
+                manifest.write(content)
+            self.reg.state.recordManifest(reg.name, project_id, path, modified=1000, fingerprint=reg.fingerprint,
+                                          expires=2000)
+        with open(reg.path, "w") as txt:
+            txt.write("".join("{}.xml\n".format(name) for name in sorted(projects.values())))
+
+    def read(self, name):
+        with open(os.path.join(self.root, name)) as f:
+            return f.read()
+
+    def testPromoteAndRollback(self):
+        staged = self.reg.staging()
+        self.build(staged, {"project-A": "A"}, "second")
+        self.reg.promote(staged.folder)
+        self.assertEqual(self.read("A.xml"), "second")
+        self.assertFalse(os.path.exists(os.path.join(self.root, "B.xml")))
+        self.assertFalse(os.path.exists(staged.folder))
+        self.assertEqual(sorted(self.reg.projects), ["project-A"])
+
+        self.reg.rollback()
+        self.assertEqual(self.read("A.xml"), "first")
+        self.assertEqual(self.read("B.xml"), "first")
+        self.assertEqual(self.read(self.reg.txt), "A.xml\nB.xml\n")
+        # the restored manifests aren't the ones recorded, so they must be rebuilt
+        self.assertEqual(self.reg.state.getBuilds(self.reg.name), {"project-A": (None, None, None)})
+        self.assertTrue(self.reg.needsBuild("project-A", {"modified": 1000}, self.reg.state.getBuilds(self.reg.name)))
+
+        self.reg.rollback()
+        self.assertEqual(self.read("A.xml"), "second")
+
+    def testForceUpdateWithTag(self):
+        self.addCleanup(setattr, registry, "dxpy", registry.dxpy)
+        registry.dxpy = TaggedDxpy
+        self.reg.state.setRegistryTag(self.reg.name, "LKCGP")
+        built = []
+        self.reg.addProjects = built.append
+        self.reg.forceUpdate()
+        self.assertEqual(TaggedDxpy.queries, [{"tags": ["LKCGP"]}])
+        self.assertEqual(built, [["project-B"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+
+from support import registry
+
+
+class ParseByteRangeTest(unittest.TestCase):
+    def testRanges(self):
+        self.assertEqual(registry.parse_byte_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(registry.parse_byte_range("bytes=900-", 1000), (900, 999))
+        self.assertEqual(registry.parse_byte_range("bytes=-100", 1000), (900, 999))
+        # beyond the end is clipped
+        self.assertEqual(registry.parse_byte_range("bytes=900-5000", 1000), (900, 999))
+        self.assertEqual(registry.parse_byte_range("bytes=-5000", 1000), (0, 999))
+
+    def testIgnored(self):
+        for header in (None, "", "items=0-9", "bytes=0-9,20-29", "bytes=a-b"):
+            self.assertIsNone(registry.parse_byte_range(header, 1000))
+
+    def testUnsatisfiable(self):
+        for header in ("bytes=1000-", "bytes=1000-1001", "bytes=10-9"):
+            self.assertRaises(ValueError, registry.parse_byte_range, header, 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
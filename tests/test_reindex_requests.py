@@ -0,0 +1,34 @@
+import unittest
+
+from support import registry
+
+
+class ReindexRequestsTest(unittest.TestCase):
+    def testFoldersAreMerged(self):
+        requests = registry.ReindexRequests(debounce=0)
+        self.assertEqual(requests.add("project-A", "/run1/bams/"), ["/run1/bams"])
+        self.assertEqual(requests.add("project-A", "run2"), ["/run1/bams", "/run2"])
+        # within a folder that is already requested
+        self.assertEqual(requests.add("project-A", "/run2/vcfs"), ["/run1/bams", "/run2"])
+        # a parent folder replaces its sub-folders
+        self.assertEqual(requests.add("project-A", "/run1"), ["/run1", "/run2"])
+        self.assertEqual(requests.takeDue(), [("project-A", {"/run1", "/run2"})])
+        self.assertEqual(requests.takeDue(), [])
+
+    def testWholeProject(self):
+        requests = registry.ReindexRequests(debounce=0)
+        requests.add("project-A", "/run1")
+        self.assertIsNone(requests.add("project-A"))
+        self.assertIsNone(requests.add("project-A", "/run2"))
+        self.assertIsNone(requests.add("project-B", "/"))
+        self.assertEqual(sorted(requests.takeDue()), [("project-A", None), ("project-B", None)])
+
+    def testDebounce(self):
+        requests = registry.ReindexRequests(debounce=60)
+        requests.add("project-A")
+        self.assertEqual(requests.takeDue(), [])
+        self.assertIn("project-A", requests.pending)
+
+
+if __name__ == "__main__":
+    unittest.main()
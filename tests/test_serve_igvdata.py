@@ -0,0 +1,81 @@
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from support import registry
+
+
+class ServeIgvdataTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.root = os.path.join(cls.tmp, "igvdata")
+        os.makedirs(os.path.join(cls.root, "LKCGP"))
+        with open(os.path.join(cls.root, "LKCGP", "track.bw"), "wb") as track:
+            track.write(b"0123456789" * 1000)
+        with open(os.path.join(cls.root, "LKCGP", "project.xml"), "w") as manifest:
+            manifest.write("<Global name=\"project\"/>\n")
+        with open(os.path.join(cls.tmp, "secret"), "w") as secret:
+            secret.write("secret")
+        os.symlink(cls.tmp, os.path.join(cls.root, "LKCGP", "outside"))
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        cls.port = sock.getsockname()[1]
+        sock.close()
+        server = threading.Thread(target=registry.serve_igvdata, args=(cls.root, cls.port), kwargs={"threads": 2})
+        server.daemon = True
+        server.start()
+        for i in range(50):
+            try:
+                socket.create_connection(("localhost", cls.port)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def request(self, path, headers=None):
+        """:return: the response, and its body"""
+        connection = httplib.HTTPConnection("localhost", self.port, timeout=10)
+        connection.request("GET", path, headers=headers or {})
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response, body
+
+    def get(self, path, headers=None):
+        response, body = self.request(path, headers)
+        return response.status, body
+
+    def testServesFiles(self):
+        self.assertEqual(self.get("/igvdata/LKCGP/track.bw"), (200, b"0123456789" * 1000))
+        self.assertEqual(self.get("/igvdata/LKCGP/track.bw", {"Range": "bytes=5-9"}), (206, b"56789"))
+
+    def testManifestsAreRevalidated(self):
+        response, body = self.request("/igvdata/LKCGP/project.xml")
+        self.assertEqual(response.status, 200)
+        self.assertIn("no-cache", response.getheader("Cache-Control"))
+        etag = response.getheader("ETag")
+        self.assertEqual(self.get("/igvdata/LKCGP/project.xml", {"If-None-Match": etag}), (304, b""))
+
+    def testNothingOutsideTheRoot(self):
+        secret = os.path.join(self.tmp, "secret")
+        for path in ("/igvdata/" + secret, "/igvdata//" + secret, "/igvdata/%2F" + secret.lstrip("/"),
+                     "/igvdata/../secret", "/igvdata/LKCGP/../../secret", "/igvdata/LKCGP/outside/secret",
+                     "/secret"):
+            self.assertEqual(self.get(path)[0], 404, path)
+
+    def testNoHiddenFiles(self):
+        for path in ("/igvdata/.state/registry.sqlite", "/igvdata/.cache", "/igvdata/LKCGP/.htaccess", "/igvdata/"):
+            self.assertEqual(self.get(path)[0], 404, path)
+
+
+if __name__ == "__main__":
+    unittest.main()
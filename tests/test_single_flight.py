@@ -0,0 +1,69 @@
+import threading
+import time
+import unittest
+
+from support import registry
+
+
+class SingleFlightTest(unittest.TestCase):
+    def testConcurrentCallersShareOneCall(self):
+        flight = registry.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(10)
+            return "block"
+
+        leader = threading.Thread(target=lambda: results.append(flight.do(("file-1", 0), fetch)))
+        leader.start()
+        started.wait(10)
+        followers = [threading.Thread(target=lambda: results.append(flight.do(("file-1", 0), fetch)))
+                     for i in range(4)]
+        for follower in followers:
+            follower.start()
+        # give the followers time to join the leader's call
+        time.sleep(0.2)
+        # another key isn't held up
+        self.assertEqual(flight.do(("file-1", 1), lambda: "other block"), "other block")
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["block"] * 5)
+        self.assertEqual(flight.calls, {})
+
+    def testExceptionIsShared(self):
+        flight = registry.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        errors = []
+
+        def fetch():
+            started.set()
+            release.wait(10)
+            raise IOError("connection reset")
+
+        def call():
+            try:
+                flight.do("file-1", fetch)
+            except IOError as e:
+                errors.append(str(e))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(10)
+        follower = threading.Thread(target=call)
+        follower.start()
+        time.sleep(0.2)
+        release.set()
+        leader.join(10)
+        follower.join(10)
+        self.assertEqual(errors, ["connection reset"] * 2)
+        # the next call runs the function again
+        self.assertEqual(flight.do("file-1", lambda: "block"), "block")
+
+
+if __name__ == "__main__":
+    unittest.main()
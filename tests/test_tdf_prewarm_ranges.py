@@ -0,0 +1,69 @@
+import struct
+import unittest
+
+from support import registry
+
+
+def tdf(datasets, groups):
+    """
+    :param datasets: list of (name, list of tile sizes)
+    :param groups: list of group names
+    :return: (a TDF file, dict of each dataset or group name -> its (start, end) range, list of the (start, end) range
+    of every tile, by dataset name)
+    """
+    header = b"\0" * 20
+    data = b""
+    offset = 24 + len(header)
+    ranges, tiles = {}, {}
+    for name, tile_sizes in datasets:
+        tiles[name] = []
+        for size in tile_sizes:
+            if size:
+                tiles[name].append((offset + len(data), offset + len(data) + size - 1))
+            data += b"\1" * size
+    # each dataset has one attribute, a data type, a tile width, and its tiles
+    for name, tile_sizes in datasets:
+        dataset = (struct.pack("<i", 1) + b"window\0mean\0" + b"FLOAT\0" + struct.pack("<fi", 700.0, len(tile_sizes)))
+        for i, size in enumerate(tile_sizes):
+            dataset += struct.pack("<qi", tiles[name][i][0] if size else 0, size)
+        ranges[name] = (offset + len(data), offset + len(data) + len(dataset) - 1)
+        data += dataset
+    for name in groups:
+        group = struct.pack("<i", 0)
+        ranges[name] = (offset + len(data), offset + len(data) + len(group) - 1)
+        data += group
+    index = b""
+    for names in ([name for name, tile_sizes in datasets], groups):
+        index += struct.pack("<i", len(names))
+        for name in names:
+            index += name.encode("utf-8") + b"\0" + struct.pack("<qi", ranges[name][0],
+                                                                 ranges[name][1] - ranges[name][0] + 1)
+    index_position = offset + len(data)
+    ranges["index"] = (index_position, index_position + len(index) - 1)
+    head = b"TDF4" + struct.pack("<iqii", 4, index_position, len(index), len(header))
+    return head + header + data + index, ranges, tiles
+
+
+def reader(data):
+    return lambda start, end: data[start:end + 1]
+
+
+class TdfPrewarmRangesTest(unittest.TestCase):
+    def testLowZoomLevels(self):
+        data, ranges, tiles = tdf([("/All/z0/mean", [10, 20]), ("/chr1/z0/mean", [30, 0]), ("/chr1/z5/mean", [40]),
+                                   ("/chr1/raw", [50])], ["/", "/chr1"])
+        expected = [(0, 23 + 20), ranges["index"], ranges["/All/z0/mean"], ranges["/chr1/z0/mean"], ranges["/"],
+                    ranges["/chr1"]] + tiles["/All/z0/mean"] + tiles["/chr1/z0/mean"]
+        self.assertEqual(registry.tdf_prewarm_ranges(reader(data)), expected)
+
+    def testZooms(self):
+        data, ranges, tiles = tdf([("/chr1/z0/mean", [10]), ("/chr1/z1/mean", [20])], [])
+        self.assertNotIn(ranges["/chr1/z1/mean"], registry.tdf_prewarm_ranges(reader(data), zooms=1))
+        self.assertIn(ranges["/chr1/z1/mean"], registry.tdf_prewarm_ranges(reader(data), zooms=2))
+
+    def testNotTdf(self):
+        self.assertRaises(ValueError, registry.tdf_prewarm_ranges, reader(b"BAM\1" + b"\0" * 40))
+
+
+if __name__ == "__main__":
+    unittest.main()
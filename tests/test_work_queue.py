@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from support import FakeDxpy, registry
+
+
+def crawled_dataset(project_id):
+    """:return: a DxDataset with a small Folder/Resource tree, as if `project_id` had been crawled"""
+    dataset = registry.DxDataset(FakeDxpy.DXProject(project_id), describe={"name": "Run 1", "modified": 1000})
+    bams = registry.Folder("bams", "/bams")
+    bams.resources.append(registry.Resource("file-1", "S1.bam", "/bams", "https://dl/S1.bam", index="https://dl/S1.bai",
+                                            coverage="."))
+    dataset.root.folders.append(bams)
+    dataset.root.resources.append(registry.Resource("file-2", "S1.vcf.gz", "/", "https://dl/S1.vcf.gz"))
+    return dataset
+
+
+class DatasetJsonTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, registry, "dxpy", registry.dxpy)
+        registry.dxpy = FakeDxpy
+
+    def testRoundTrip(self):
+        dataset = crawled_dataset("project-A")
+        loaded = registry.dataset_from_json(registry.dataset_to_json(dataset))
+        self.assertEqual(loaded.project.get_id(), "project-A")
+        self.assertEqual((loaded.name, loaded.modified, loaded.filename), ("Run 1", 1000, "Run 1"))
+        self.assertEqual([(folder.path, folder.resources) for folder in loaded.root.walk()],
+                         [(folder.path, folder.resources) for folder in dataset.root.walk()])
+        self.assertTrue(all(isinstance(resource, registry.Resource) for resource in loaded.root.getResources()))
+
+    def testNotADataset(self):
+        # eg a pickle, which must not be loaded
+        self.assertRaises(ValueError, registry.dataset_from_json, b"cos\nsystem\n(S'true'\ntR.")
+        self.assertRaises(ValueError, registry.dataset_from_json, '{"name": "Run 1"}')
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, registry, "dxpy", registry.dxpy)
+        registry.dxpy = FakeDxpy
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "queue.sqlite")
+        self.queue = registry.WorkQueue(self.path)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp)
+
+    def testIdenticalCrawlsAreShared(self):
+        job_id = self.queue.put("project-A", "1kg_v37", 3600)
+        self.assertEqual(self.queue.put("project-A", "1kg_v37", 3600), job_id)
+        self.assertNotEqual(self.queue.put("project-A", "hg38", 3600), job_id)
+
+    def testLease(self):
+        first = self.queue.put("project-A", "1kg_v37", 3600, {"name": "Run 1"})
+        second = self.queue.put("project-B", "1kg_v37", 3600)
+        self.assertEqual(self.queue.take("host1:1"), (first, "project-A", "1kg_v37", 3600, {"name": "Run 1"}))
+        self.assertEqual(self.queue.take("host2:1")[0], second)
+        self.assertIsNone(self.queue.take("host3:1"))
+        self.assertTrue(self.queue.renew(first, "host1:1"))
+        self.assertFalse(self.queue.renew(first, "host2:1"))
+
+    def testExpiredLeaseIsReclaimed(self):
+        job_id = self.queue.put("project-A", "1kg_v37", 3600)
+        expired = registry.WorkQueue(self.path, lease=-10)
+        self.assertEqual(expired.take("host1:1")[0], job_id)
+        expired.close()
+        self.assertEqual(self.queue.take("host2:1")[0], job_id)
+        # the first worker has lost the job
+        self.assertFalse(self.queue.renew(job_id, "host1:1"))
+        self.assertTrue(self.queue.renew(job_id, "host2:1"))
+
+    def testLeaseExpiresUntilMaxAttempts(self):
+        job_id = self.queue.put("project-A", "1kg_v37", 3600)
+        expired = registry.WorkQueue(self.path, lease=-10)
+        for attempt in range(registry.WorkQueue.MAX_ATTEMPTS):
+            self.assertEqual(expired.take("host1:1")[0], job_id)
+        # every worker died, so the job fails rather than being leased forever
+        self.assertIsNone(expired.take("host1:1"))
+        expired.close()
+        self.assertEqual(self.queue.db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0],
+                         "failed")
+
+    def testFailedJobsAreRetried(self):
+        job_id = self.queue.put("project-A", "1kg_v37", 3600)
+        for attempt in range(registry.WorkQueue.MAX_ATTEMPTS):
+            self.assertEqual(self.queue.take("host1:1")[0], job_id)
+            self.queue.fail(job_id, "host1:1", "IOError: timed out")
+        self.assertIsNone(self.queue.take("host1:1"))
+
+    def testMap(self):
+        finished = threading.Event()
+
+        def work():
+            queue = registry.WorkQueue(self.path)
+            while not finished.is_set():
+                job = queue.take("host1:1")
+                if job is None:
+                    finished.wait(0.01)
+                elif job[1] == "project-A":
+                    queue.complete(job[0], "host1:1", crawled_dataset(job[1]))
+                else:
+                    queue.fail(job[0], "host1:1", "ResourceNotFound: {}".format(job[1]))
+            queue.close()
+
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        datasets = list(self.queue.map(["project-A", "project-B"], "1kg_v37", 3600, interval=0.01))
+        finished.set()
+        worker.join(10)
+        self.assertEqual([dataset.project.get_id() for dataset in datasets], ["project-A"])
+        self.assertEqual(datasets[0].root.folders[0].resources[0].name, "S1.bam")
+        # handled jobs are deleted
+        self.assertEqual(self.queue.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0], 0)
+
+    def testSharedJobIsKeptForTheOtherCoordinator(self):
+        other = registry.WorkQueue(self.path)
+        self.addCleanup(other.close)
+        # another coordinator queued the crawl, and a worker is crawling it
+        job_id = other.put("project-A", "1kg_v37", 3600)
+        self.assertEqual(self.queue.take("host1:1")[0], job_id)
+
+        def complete():
+            queue = registry.WorkQueue(self.path)
+            queue.complete(job_id, "host1:1", crawled_dataset("project-A"))
+            queue.close()
+
+        worker = threading.Timer(0.1, complete)
+        worker.start()
+        datasets = list(self.queue.map(["project-A"], "1kg_v37", 3600, interval=0.01))
+        worker.join(10)
+        self.assertEqual([dataset.project.get_id() for dataset in datasets], ["project-A"])
+        # the other coordinator hasn't read the job yet
+        self.assertEqual(other.db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0], "done")
+        other.release(job_id)
+        self.assertEqual(self.queue.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0], 0)
+
+    def testStoppedWaitReleasesJobs(self):
+        stop = threading.Event()
+        stop.set()
+        self.assertEqual(list(self.queue.map(["project-A"], "1kg_v37", 3600, stop=stop)), [])
+        self.assertEqual(self.queue.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()